@@ -0,0 +1,449 @@
+# coding=utf-8
+
+"""
+A small zip writer for EPUB containers.
+
+Unlike :class:`zipfile.ZipFile`, it never seeks or reads back, so the target can be any object with a ``write``
+method: a file, a socket file, a pipe. Entries are written chunk by chunk, peak memory does not depend on the size
+of the book.
+"""
+
+import os
+import struct
+import time
+import zlib
+
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED, ZIP64_LIMIT, LargeZipFile
+
+
+CHUNK_SIZE = 64 * 1024
+
+_MAX_32 = 0xFFFFFFFF
+_MAX_16 = 0xFFFF
+
+_LOCAL_FILE_HEADER = struct.Struct('<IHHHHHIIIHH')
+_CENTRAL_DIRECTORY = struct.Struct('<IHHHHHHIIIHHHHHII')
+_DATA_DESCRIPTOR = struct.Struct('<IIII')
+_DATA_DESCRIPTOR64 = struct.Struct('<IIQQ')
+_END_OF_CENTRAL_DIRECTORY = struct.Struct('<IHHHHIIH')
+_END_OF_CENTRAL_DIRECTORY64 = struct.Struct('<IQHHIIQQQQ')
+_END_OF_CENTRAL_DIRECTORY64_LOCATOR = struct.Struct('<IIQI')
+
+_VERSION = 20
+_VERSION64 = 45
+_CREATE_SYSTEM = 3  # unix
+
+_FLAG_DATA_DESCRIPTOR = 0x08
+_FLAG_UTF8 = 0x800
+_FLAG_ENCRYPTED = 0x01
+
+
+class _Entry(object):
+    def __init__(self, name, compress_type, date_time, offset, zip64):
+        self.name = name
+        self.compress_type = compress_type
+        self.date_time = date_time
+        self.offset = offset
+        self.zip64 = zip64
+
+        self.flag_bits = 0
+        self.crc = 0
+        self.compress_size = 0
+        self.file_size = 0
+
+        try:
+            self.name_bytes = name.encode('ascii')
+        except UnicodeEncodeError:
+            self.name_bytes = name.encode('utf-8')
+            self.flag_bits |= _FLAG_UTF8
+
+    @property
+    def dos_time(self):
+        return self.date_time[3] << 11 | self.date_time[4] << 5 | self.date_time[5] // 2
+
+    @property
+    def dos_date(self):
+        return (self.date_time[0] - 1980) << 9 | self.date_time[1] << 5 | self.date_time[2]
+
+    def local_header(self):
+        extra = b''
+        version = _VERSION
+        crc, compress_size, file_size = self.crc, self.compress_size, self.file_size
+
+        if self.zip64:
+            version = _VERSION64
+            extra = struct.pack('<HHQQ', 1, 16, file_size, compress_size)
+            compress_size = file_size = _MAX_32
+
+        return _LOCAL_FILE_HEADER.pack(0x04034b50, version, self.flag_bits, self.compress_type,
+                                       self.dos_time, self.dos_date, crc, compress_size, file_size,
+                                       len(self.name_bytes), len(extra)) + self.name_bytes + extra
+
+    def data_descriptor(self):
+        if self.zip64:
+            return _DATA_DESCRIPTOR64.pack(0x08074b50, self.crc, self.compress_size, self.file_size)
+        else:
+            return _DATA_DESCRIPTOR.pack(0x08074b50, self.crc, self.compress_size, self.file_size)
+
+    def central_directory(self):
+        fields = []
+        file_size, compress_size, offset = self.file_size, self.compress_size, self.offset
+
+        if file_size >= _MAX_32:
+            fields.append(file_size)
+            file_size = _MAX_32
+
+        if compress_size >= _MAX_32:
+            fields.append(compress_size)
+            compress_size = _MAX_32
+
+        if offset >= _MAX_32:
+            fields.append(offset)
+            offset = _MAX_32
+
+        extra = b''
+        version = _VERSION
+        if fields:
+            version = _VERSION64
+            extra = struct.pack('<HH' + 'Q' * len(fields), 1, 8 * len(fields), *fields)
+
+        return _CENTRAL_DIRECTORY.pack(0x02014b50, _CREATE_SYSTEM << 8 | version, version, self.flag_bits,
+                                       self.compress_type, self.dos_time, self.dos_date, self.crc, compress_size,
+                                       file_size, len(self.name_bytes), len(extra), 0, 0, 0, 0o100644 << 16,
+                                       offset) + self.name_bytes + extra
+
+
+class _RawEntryWriter(object):
+    """File-like object for one zip entry, takes data as it is stored in the zip, returned by
+    :meth:`ZipWriter.open_raw`."""
+    def __init__(self, zip_writer, entry):
+        self._zip_writer = zip_writer
+        self._entry = entry
+        self._compress_size = 0
+        self._closed = False
+        self._failed = False
+
+    def _check(self):
+        if self._failed:
+            raise ValueError('Attempt to write to a failed entry')
+
+    def _fail(self):
+        # the data written stays in the zip, but the entry is not put in the central directory
+        self._failed = True
+        self._zip_writer._entries.remove(self._entry)
+        self._zip_writer._names.discard(self._entry.name)
+        self._zip_writer._writing = False
+
+    def write(self, data):
+        self._check()
+        if data:
+            self._compress_size += len(data)
+            self._zip_writer._write(data)
+
+    def close(self, crc, file_size):
+        """
+        :param crc: crc32 of the uncompressed data
+        :type crc: int
+        :param file_size: size of the uncompressed data
+        :type file_size: int
+        """
+        self._check()
+        entry = self._entry
+        entry.crc = crc & _MAX_32
+        entry.file_size = file_size
+        entry.compress_size = self._compress_size
+
+        if not entry.zip64 and (entry.file_size > ZIP64_LIMIT or entry.compress_size > ZIP64_LIMIT):
+            self._fail()
+            raise LargeZipFile('{} is too large, give its size when open it'.format(entry.name))
+
+        try:
+            self._zip_writer._write(entry.data_descriptor())
+        except Exception:
+            self._fail()
+            raise
+
+        self._closed = True
+        self._zip_writer._writing = False
+
+
+class _EntryWriter(_RawEntryWriter):
+    """File-like object for one zip entry, compresses what it gets, returned by :meth:`ZipWriter.open`."""
+    def __init__(self, zip_writer, entry, level):
+        _RawEntryWriter.__init__(self, zip_writer, entry)
+
+        self._compressor = None
+        if entry.compress_type == ZIP_DEFLATED:
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+
+        self._crc = 0
+        self._file_size = 0
+
+    def write(self, data):
+        self._check()
+        self._crc = zlib.crc32(data, self._crc)
+        self._file_size += len(data)
+
+        if self._compressor:
+            data = self._compressor.compress(data)
+
+        _RawEntryWriter.write(self, data)
+
+    def close(self):
+        self._check()
+        if self._compressor:
+            _RawEntryWriter.write(self, self._compressor.flush())
+            self._compressor = None
+
+        _RawEntryWriter.close(self, self._crc, self._file_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+
+        elif not (self._closed or self._failed):
+            # the data may be short, the entry is left out, the exception goes on
+            self._fail()
+
+
+class ZipWriter(object):
+    def __init__(self, fileobj, date_time=None):
+        """
+        :param fileobj: object to write to, only it's ``write`` method is used.
+        :param date_time: time stamp of all entries, tuple of (year, month, day, hour, minute, second),
+         default is now.
+        :type date_time: tuple
+        """
+        self._fp = fileobj
+        self._offset = 0
+        self._entries = []
+        self._names = set()
+        self._writing = False
+        self._closed = False
+
+        self.date_time = tuple(date_time or time.localtime()[:6])
+
+    def _write(self, data):
+        self._fp.write(data)
+        self._offset += len(data)
+
+    def _new_entry(self, name, compress_type, zip64=False):
+        if self._closed:
+            raise ValueError('Attempt to write to a closed zip')
+
+        if self._writing:
+            raise ValueError('Can not write while an other entry is open')
+
+        name = name.replace(os.sep, '/')
+
+        if name in self._names:
+            raise ValueError('Duplicate name: {}'.format(name))
+
+        if compress_type not in (ZIP_STORED, ZIP_DEFLATED):
+            raise ValueError('Unsupported compression type: {}'.format(compress_type))
+
+        self._names.add(name)
+
+        entry = _Entry(name, compress_type, self.date_time, self._offset, zip64)
+        self._entries.append(entry)
+
+        return entry
+
+    def writestr(self, name, data, compress_type=ZIP_DEFLATED, level=zlib.Z_DEFAULT_COMPRESSION):
+        """Write a whole entry from bytes. The local header carries the real sizes and crc, with no data descriptor,
+        which is what the `mimetype` entry of an EPUB needs.
+
+        :param name: path in the zip
+        :type name: str
+        :param data: content
+        :type data: bytes
+        :param compress_type: zipfile.ZIP_STORED or zipfile.ZIP_DEFLATED
+        :param level: compression level
+        :type level: int
+        """
+        file_size = len(data)
+        crc = zlib.crc32(data) & _MAX_32
+
+        if compress_type == ZIP_DEFLATED:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+            data = compressor.compress(data) + compressor.flush()
+
+        entry = self._new_entry(name, compress_type, zip64=file_size > ZIP64_LIMIT or len(data) > ZIP64_LIMIT)
+        entry.crc = crc
+        entry.file_size = file_size
+        entry.compress_size = len(data)
+
+        self._write(entry.local_header())
+        self._write(data)
+
+    def open(self, name, compress_type=ZIP_DEFLATED, level=zlib.Z_DEFAULT_COMPRESSION, file_size=None):
+        """Open an entry for streaming write, crc and sizes go to a data descriptor after the data.
+
+        :param name: path in the zip
+        :type name: str
+        :param compress_type: zipfile.ZIP_STORED or zipfile.ZIP_DEFLATED
+        :param level: compression level
+        :type level: int
+        :param file_size: expected size of the data, entry will use zip64 when it is large. If None, writing more than
+         2 GiB raises :class:`zipfile.LargeZipFile`
+        :type file_size: int
+        :return: file-like object, has ``write`` and ``close``
+        """
+        zip64 = file_size is not None and file_size * 1.05 > ZIP64_LIMIT
+
+        entry = self._new_entry(name, compress_type, zip64=zip64)
+        entry.flag_bits |= _FLAG_DATA_DESCRIPTOR
+
+        self._write(entry.local_header())
+        self._writing = True
+
+        return _EntryWriter(self, entry, level)
+
+    def open_raw(self, name, compress_type=ZIP_DEFLATED, file_size=None):
+        """Like :meth:`open`, but data is written as it is stored in the zip, for example raw deflate streams which
+        compressed somewhere else. Give the crc and the uncompressed size when close it.
+
+        :param name: path in the zip
+        :type name: str
+        :param compress_type: zipfile.ZIP_STORED or zipfile.ZIP_DEFLATED
+        :param file_size: expected size of the uncompressed data
+        :type file_size: int
+        :return: file-like object, has ``write`` and ``close(crc, file_size)``
+        """
+        zip64 = file_size is not None and file_size * 1.05 > ZIP64_LIMIT
+
+        entry = self._new_entry(name, compress_type, zip64=zip64)
+        entry.flag_bits |= _FLAG_DATA_DESCRIPTOR
+
+        self._write(entry.local_header())
+        self._writing = True
+
+        return _RawEntryWriter(self, entry)
+
+    def close(self):
+        """Write central directory, the zip is finished after this."""
+        if self._closed:
+            return
+
+        if self._writing:
+            raise ValueError('Can not close while an entry is open')
+
+        cd_offset = self._offset
+        for entry in self._entries:
+            self._write(entry.central_directory())
+        cd_size = self._offset - cd_offset
+
+        count = len(self._entries)
+
+        if count > _MAX_16 or cd_offset >= _MAX_32 or cd_size >= _MAX_32:
+            end64_offset = self._offset
+            self._write(_END_OF_CENTRAL_DIRECTORY64.pack(0x06064b50, 44, _CREATE_SYSTEM << 8 | _VERSION64, _VERSION64,
+                                                         0, 0, count, count, cd_size, cd_offset))
+            self._write(_END_OF_CENTRAL_DIRECTORY64_LOCATOR.pack(0x07064b50, 0, end64_offset, 1))
+
+            count = min(count, _MAX_16)
+            cd_size = min(cd_size, _MAX_32)
+            cd_offset = min(cd_offset, _MAX_32)
+
+        self._write(_END_OF_CENTRAL_DIRECTORY.pack(0x06054b50, 0, 0, count, count, cd_size, cd_offset, 0))
+
+        if hasattr(self._fp, 'flush'):
+            self._fp.flush()
+
+        self._closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+
+
+class _RawReader(object):
+    """Read a range of a file, file position is set before every read so others can share the file."""
+    def __init__(self, fp, offset, size):
+        self._fp = fp
+        self._pos = offset
+        self._left = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self._left:
+            size = self._left
+
+        if not size:
+            return b''
+
+        self._fp.seek(self._pos)
+        data = self._fp.read(size)
+
+        self._pos += len(data)
+        self._left -= len(data)
+
+        return data
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ZipReader(object):
+    """Read entries of an existing zip, decompressed or as they are stored."""
+    def __init__(self, file):
+        """
+        :param file: path, or seekable binary file-like object
+        """
+        self._own_fp = not hasattr(file, 'read')
+        self._fp = open(file, 'rb') if self._own_fp else file
+        self._zip = ZipFile(self._fp)
+
+    def getinfo(self, name):
+        """
+        :return: object of :class:`zipfile.ZipInfo`, None if no such entry
+        """
+        try:
+            return self._zip.getinfo(name)
+        except KeyError:
+            return None
+
+    def open(self, name):
+        """
+        :return: file-like object to read decompressed data
+        """
+        return self._zip.open(name)
+
+    def open_raw(self, name):
+        """
+        :return: file-like object to read data as it is stored in the zip
+        """
+        info = self._zip.getinfo(name)
+        if info.flag_bits & _FLAG_ENCRYPTED:
+            raise ValueError('{} is encrypted'.format(name))
+
+        self._fp.seek(info.header_offset)
+        header = self._fp.read(_LOCAL_FILE_HEADER.size)
+        fields = _LOCAL_FILE_HEADER.unpack(header)
+        if fields[0] != 0x04034b50:
+            raise ValueError('Bad local file header of {}'.format(name))
+
+        offset = info.header_offset + _LOCAL_FILE_HEADER.size + fields[9] + fields[10]
+        return _RawReader(self._fp, offset, info.compress_size)
+
+    def close(self):
+        self._zip.close()
+        if self._own_fp:
+            self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
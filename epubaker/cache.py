@@ -0,0 +1,198 @@
+# coding=utf-8
+
+"""
+On-disk cache of compressed zip entries, shared by builds.
+
+Entries are keyed by the hash of their content and the compression settings, a hit is spliced into the zip as it is,
+without compressing again. Files are written to a temporary name and renamed in place, so builds running at the same
+time on one host can share a directory. The least recently used entries are removed when the directory grows beyond
+its size limit.
+"""
+
+import hashlib
+import os
+import struct
+import time
+import uuid
+
+from epubaker.archive import CHUNK_SIZE
+
+
+_MAGIC = b'EPZC'
+_HEADER = struct.Struct('<4sIQ')
+
+_VERSION = 1
+
+_TMP_SUFFIX = '.tmp'
+_STALE_TMP_AGE = 60 * 60
+
+
+class EntryCache(object):
+    def __init__(self, directory, max_size=1024 * 1024 * 1024):
+        """
+        :param directory: where to keep the cache, made if not exist
+        :type directory: str
+        :param max_size: the most bytes the cache can use, the least recently used entries are removed beyond it
+        :type max_size: int
+        """
+        self.directory = directory
+        self.max_size = max_size
+
+        self._size = None
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def key(file_, level):
+        """
+        :param file_: object of :class:`epubaker.File`
+        :param level: compression level
+        :type level: int
+        :return: key of the compressed file_
+        :rtype: str
+        """
+        h = hashlib.sha256('epubaker-deflate-{}-{}\n'.format(_VERSION, level).encode('ascii'))
+        for chunk in file_.iter_chunks(CHUNK_SIZE):
+            h.update(chunk)
+
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """
+        :param key: see :meth:`key`
+        :type key: str
+        :return: (crc, file_size, fileobj), fileobj is open at the compressed data, close it after use.
+         None if not in the cache
+        :rtype: tuple
+        """
+        path = self._path(key)
+
+        try:
+            f = open(path, 'rb')
+        except (IOError, OSError):
+            return None
+
+        header = f.read(_HEADER.size)
+        if len(header) != _HEADER.size or header[:4] != _MAGIC:
+            f.close()
+            self._remove(path)
+            return None
+
+        try:
+            # mark as recently used
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        _, crc, file_size = _HEADER.unpack(header)
+        return crc, file_size, f
+
+    def open_writer(self, key):
+        """
+        :param key: see :meth:`key`
+        :type key: str
+        :return: file-like object, :meth:`_CacheWriter.commit` puts what is written to the cache
+        """
+        return _CacheWriter(self, key)
+
+    def _added(self, size):
+        if self._size is None:
+            self._size = self._scan_size()
+        else:
+            self._size += size
+
+        if self._size > self.max_size:
+            self.evict()
+
+    def _scan_size(self):
+        return sum(size for _, size, _ in self._iter_files())
+
+    def _iter_files(self):
+        for sub in os.listdir(self.directory):
+            sub_path = os.path.join(self.directory, sub)
+            if not os.path.isdir(sub_path):
+                continue
+
+            for name in os.listdir(sub_path):
+                path = os.path.join(sub_path, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+
+                if name.endswith(_TMP_SUFFIX):
+                    # left by a build which was killed
+                    if time.time() - stat.st_mtime > _STALE_TMP_AGE:
+                        self._remove(path)
+                    continue
+
+                yield path, stat.st_size, stat.st_mtime
+
+    def evict(self):
+        """Remove the least recently used entries, until the cache uses less than 90% of max_size."""
+        files = sorted(self._iter_files(), key=lambda one: one[2])
+        total = sum(size for _, size, _ in files)
+
+        limit = self.max_size * 0.9
+        for path, size, _ in files:
+            if total <= limit:
+                break
+
+            if self._remove(path):
+                total -= size
+
+        self._size = total
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            # other build removed it, or it is open on Windows
+            return False
+        return True
+
+
+class _CacheWriter(object):
+    def __init__(self, cache, key):
+        self._cache = cache
+        self._path = cache._path(key)
+
+        dire = os.path.dirname(self._path)
+        if not os.path.isdir(dire):
+            try:
+                os.makedirs(dire)
+            except OSError:
+                # made by other build just now
+                pass
+
+        self._tmp_path = '{}.{}{}'.format(self._path, uuid.uuid4().hex, _TMP_SUFFIX)
+        self._f = open(self._tmp_path, 'wb')
+        self._f.write(_HEADER.pack(_MAGIC, 0, 0))
+        self._size = _HEADER.size
+
+    def write(self, data):
+        self._f.write(data)
+        self._size += len(data)
+
+    def commit(self, crc, file_size):
+        """
+        :param crc: crc32 of the uncompressed data
+        :type crc: int
+        :param file_size: size of the uncompressed data
+        :type file_size: int
+        """
+        self._f.seek(0)
+        self._f.write(_HEADER.pack(_MAGIC, crc, file_size))
+        self._f.close()
+
+        os.replace(self._tmp_path, self._path)
+        self._cache._added(self._size)
+
+    def abort(self):
+        self._f.close()
+        self._cache._remove(self._tmp_path)
@@ -0,0 +1,359 @@
+# coding=utf-8
+
+"""
+Compress zip entries, on the calling thread or on a pool of workers.
+
+With a pool, every entry is cut into blocks, the blocks are deflated concurrently and their outputs are joined into
+one raw deflate stream, the way pigz does: each block but the last ends with a sync flush, and uses the 32 KiB before
+it as preset dictionary, so the ratio stays close to compressing in one go. zlib releases the GIL, threads are fine
+on CPython, processes are there for interpreters where that doesn't help, like PyPy.
+"""
+
+import collections
+import hashlib
+import os
+import zlib
+
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+
+from zipfile import ZIP_STORED, ZIP_DEFLATED
+
+from epubaker import mimes
+from epubaker.archive import CHUNK_SIZE
+
+
+BLOCK_SIZE = 256 * 1024
+
+_WINDOW_SIZE = 32 * 1024
+
+STORED_MIMES = frozenset([
+    mimes.GIF, mimes.JPEG, mimes.PNG,
+    mimes.FONT_WOFF, mimes.FONT_WOFF2,
+    mimes.MP3, mimes.AAC,
+])
+"""Media types those are compressed already, deflate hardly makes them smaller."""
+
+
+class CompressionPolicy(object):
+    """Decide how every file is stored in the zip."""
+    def __init__(self, stored_mimes=STORED_MIMES, sample_size=None, min_gain=0.05):
+        """
+        :param stored_mimes: files of these media types are stored without compression
+        :type stored_mimes: set
+        :param sample_size: if given, deflate the first sample_size bytes of other files, and store them
+         without compression when it doesn't save at least min_gain
+        :type sample_size: int
+        :param min_gain: the least part of the sample deflate has to save, 0.05 is 5%
+        :type min_gain: float
+        """
+        self.stored_mimes = frozenset(stored_mimes)
+        self.sample_size = sample_size
+        self.min_gain = min_gain
+
+    def compress_type(self, path, file_):
+        """
+        :param path: file path in the book
+        :type path: str
+        :param file_: object of :class:`epubaker.File`
+        :return: zipfile.ZIP_STORED or zipfile.ZIP_DEFLATED
+        :rtype: int
+        """
+        if file_.compress_type is not None:
+            return file_.compress_type
+
+        mime = file_.mime or mimes.map_from_extension.get(os.path.splitext(path)[1].lower())
+        if mime in self.stored_mimes:
+            return ZIP_STORED
+
+        if self.sample_size and not self._worth_deflating(file_):
+            return ZIP_STORED
+
+        return ZIP_DEFLATED
+
+    def _worth_deflating(self, file_):
+        chunks = file_.iter_chunks(self.sample_size)
+        try:
+            sample = next(chunks, b'')
+        finally:
+            chunks.close()
+
+        if not sample:
+            return True
+
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        compressed_size = len(compressor.compress(sample)) + len(compressor.flush())
+
+        return 1 - compressed_size / float(len(sample)) >= self.min_gain
+
+
+def _crc_and_digest(chunks):
+    crc = 0
+    h = hashlib.sha256()
+    for chunk in chunks:
+        crc = zlib.crc32(chunk, crc)
+        h.update(chunk)
+
+    return crc & 0xFFFFFFFF, h.digest()
+
+
+def _deflate_block(block, zdict, level, final):
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+class Compressor(object):
+    def __init__(self, workers=None, executor='thread', level=zlib.Z_DEFAULT_COMPRESSION, block_size=BLOCK_SIZE,
+                 cache=None, base=None):
+        """
+        :param workers: number of workers, compress on the calling thread if None or 1
+        :type workers: int
+        :param executor: 'thread', 'process', or a :class:`concurrent.futures.Executor` to use, it won't be shut down
+        :param level: compression level
+        :type level: int
+        :param block_size: size of blocks entries are cut into for the workers
+        :type block_size: int
+        :param cache: reuse compressed entries of earlier builds
+        :type cache: epubaker.cache.EntryCache
+        :param base: copy entries those are not changed from this zip as they are stored
+        :type base: epubaker.archive.ZipReader
+        """
+        if not (executor in ('thread', 'process') or isinstance(executor, Executor)):
+            raise ValueError('executor must be "thread", "process" or an Executor')
+
+        self.workers = workers
+        self.executor = executor
+        self.level = level
+        self.block_size = block_size
+        self.cache = cache
+        self.base = base
+
+        self._pool = None
+        self._own_pool = False
+
+    @property
+    def parallel(self):
+        return isinstance(self.executor, Executor) or (self.workers is not None and self.workers > 1)
+
+    def __enter__(self):
+        if isinstance(self.executor, Executor):
+            self._pool = self.executor
+
+        elif self.parallel:
+            pool_class = ThreadPoolExecutor if self.executor == 'thread' else ProcessPoolExecutor
+            self._pool = pool_class(max_workers=self.workers)
+            self._own_pool = True
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._own_pool:
+            self._pool.shutdown(wait=True)
+
+        self._pool = None
+        self._own_pool = False
+
+    def _lookup(self, name, file_, compress_type):
+        """
+        :return: (cache key, hit), key is None if the entry is not for the cache, hit is (crc, file_size, fileobj
+         to read the stored data), None if missed
+        """
+        if self.base is not None:
+            hit = self._lookup_base(name, file_, compress_type)
+            if hit:
+                return None, hit
+
+        if self.cache is None or compress_type != ZIP_DEFLATED:
+            return None, None
+
+        key = self.cache.key(file_, self.level)
+        return key, self.cache.get(key)
+
+    def _lookup_base(self, name, file_, compress_type):
+        info = self.base.getinfo(name)
+
+        if info is None or info.compress_type != compress_type:
+            return None
+
+        if file_.size is not None and file_.size != info.file_size:
+            return None
+
+        crc, digest = _crc_and_digest(file_.iter_chunks(CHUNK_SIZE))
+        if crc != info.CRC:
+            return None
+
+        # same crc, make sure by content hash
+        with self.base.open(name) as f:
+            if digest != _crc_and_digest(iter(lambda: f.read(CHUNK_SIZE), b''))[1]:
+                return None
+
+        return info.CRC, info.file_size, self.base.open_raw(name)
+
+    def write_entries(self, zip_writer, entries):
+        """Write entries to zip_writer, yield after every chunk is written.
+
+        :param zip_writer: object of :class:`epubaker.archive.ZipWriter`
+        :param entries: iterable of (name, :class:`epubaker.File`, compress_type)
+        """
+        if self._pool is None:
+            for name, file_, compress_type in entries:
+                for _ in self._write_entry(zip_writer, name, file_, compress_type):
+                    yield
+
+        else:
+            for _ in self._write_entries_parallel(zip_writer, entries):
+                yield
+
+    def _write_entry(self, zip_writer, name, file_, compress_type):
+        key, hit = self._lookup(name, file_, compress_type)
+
+        if hit:
+            crc, file_size, f = hit
+            entry = zip_writer.open_raw(name, compress_type, file_size=file_size)
+            with f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    entry.write(chunk)
+                    yield
+            entry.close(crc, file_size)
+            return
+
+        compressor = None
+        if compress_type == ZIP_DEFLATED:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+
+        entry = zip_writer.open_raw(name, compress_type, file_size=file_.size)
+        cache_writer = self.cache.open_writer(key) if key else None
+
+        crc = 0
+        file_size = 0
+        committed = False
+        try:
+            for chunk in file_.iter_chunks(CHUNK_SIZE):
+                crc = zlib.crc32(chunk, crc)
+                file_size += len(chunk)
+
+                data = compressor.compress(chunk) if compressor else chunk
+                entry.write(data)
+                if cache_writer:
+                    cache_writer.write(data)
+                yield
+
+            if compressor:
+                data = compressor.flush()
+                entry.write(data)
+                if cache_writer:
+                    cache_writer.write(data)
+
+            entry.close(crc, file_size)
+            if cache_writer:
+                cache_writer.commit(crc, file_size)
+            committed = True
+
+        finally:
+            if cache_writer and not committed:
+                cache_writer.abort()
+
+    def _write_entries_parallel(self, zip_writer, entries):
+        # Blocks of one entry and of following entries are in flight together, so small entries keep all workers
+        # busy as well. The window bounds memory: at most this many blocks are read and not written yet.
+        window = (self.workers or os.cpu_count() or 1) * 4
+
+        jobs = self._iter_jobs(entries)
+        queue = collections.deque()
+        in_flight = 0
+        exhausted = False
+
+        entry = None
+        cache_writer = None
+        try:
+            while True:
+                while not exhausted and in_flight < window:
+                    try:
+                        job = next(jobs)
+                    except StopIteration:
+                        exhausted = True
+                    else:
+                        queue.append(job)
+                        if job[0] == 'data':
+                            in_flight += 1
+
+                if not queue:
+                    break
+
+                job = queue.popleft()
+
+                if job[0] == 'open':
+                    _, name, compress_type, file_size, key = job
+                    entry = zip_writer.open_raw(name, compress_type, file_size=file_size)
+                    cache_writer = self.cache.open_writer(key) if key else None
+
+                elif job[0] == 'data':
+                    _, data = job
+                    in_flight -= 1
+
+                    if not isinstance(data, (bytes, memoryview)):
+                        data = data.result()
+
+                    entry.write(data)
+                    if cache_writer:
+                        cache_writer.write(data)
+                    yield
+
+                elif job[0] == 'close':
+                    _, crc, file_size = job
+                    entry.close(crc, file_size)
+                    entry = None
+
+                    if cache_writer:
+                        cache_writer.commit(crc, file_size)
+                        cache_writer = None
+
+        finally:
+            if cache_writer:
+                cache_writer.abort()
+
+    def _iter_jobs(self, entries):
+        for name, file_, compress_type in entries:
+            key, hit = self._lookup(name, file_, compress_type)
+
+            if hit:
+                crc, file_size, f = hit
+                yield 'open', name, compress_type, file_size, None
+                with f:
+                    for chunk in iter(lambda: f.read(self.block_size), b''):
+                        yield 'data', chunk
+                yield 'close', crc, file_size
+                continue
+
+            yield 'open', name, compress_type, file_.size, key
+
+            crc = 0
+            file_size = 0
+
+            if compress_type == ZIP_DEFLATED:
+                zdict = None
+                block = None
+
+                for next_block in file_.iter_chunks(self.block_size):
+                    next_block = bytes(next_block)
+                    crc = zlib.crc32(next_block, crc)
+                    file_size += len(next_block)
+
+                    if block is not None:
+                        yield 'data', self._pool.submit(_deflate_block, block, zdict, self.level, False)
+                        zdict = block[-_WINDOW_SIZE:]
+
+                    block = next_block
+
+                yield 'data', self._pool.submit(_deflate_block, block or b'', zdict, self.level, True)
+
+            else:
+                for block in file_.iter_chunks(self.block_size):
+                    crc = zlib.crc32(block, crc)
+                    file_size += len(block)
+                    yield 'data', block
+
+            yield 'close', crc, file_size
@@ -1,11 +1,14 @@
 # coding=utf-8
 
-import string
 import uuid
 
 import io
 import os
-import random
+import pickle
+import posixpath
+import weakref
+import itertools
+from zipfile import ZIP_STORED, ZIP_DEFLATED
 from PIL import Image
 from abc import abstractmethod
 from hooky import List, Dict
@@ -13,17 +16,83 @@ from hooky import List, Dict
 
 import epubaker.version
 from epubaker import mimes
+from epubaker.archive import ZipWriter, ZipReader, CHUNK_SIZE
+from epubaker.compression import Compressor, CompressionPolicy
 from epubaker.metas import Identifier
+from epubaker.opf import iter_opf_pieces
 from epubaker.tools import relative_path
-from epubaker.xl import Xl, Element, pretty_insert
+from epubaker.xl import Xl, Element, iter_encoded
 
 
-CONTAINER_PATH = 'META-INF' + os.sep + 'container.xml'
+CONTAINER_PATH = 'META-INF/container.xml'
 ROOT_OF_OPF = 'EPUB'
 
 OPF_NS = 'http://www.idpf.org/2007/opf'
 
 
+# Incremented whenever a book takes the key of a container, see _item_changed
+_epoch = [0]
+
+
+def _item_changed(item):
+    """
+    Count a change of item, like a File's mime or a sub Section, in the _version of the containers it is in, so only
+    caches of the books those containers belong to are out of date. Sections in sub sections pass it up to the Toc,
+    with a stack instead of recursion.
+
+    :param item: object of :class:`File`, :class:`Joint` or :class:`Section`
+    """
+    stack = [item]
+    while stack:
+        one = stack.pop()
+
+        # told its containers already, and no book took a key since then
+        if one._told == _epoch[0]:
+            continue
+        one._told = _epoch[0]
+
+        for ref in one._owners:
+            owner = ref()
+            if owner is None:
+                continue
+
+            if isinstance(owner, _SubSections):
+                stack.append(owner._section)
+            else:
+                owner._version += 1
+
+
+def _hooked_items(key, item):
+    """
+    :return: items a hook of a list-like container is called for, a slice of them is deleted at once
+    :rtype: list
+    """
+    return item if isinstance(key, slice) else [item]
+
+
+class _Item(object):
+    """Object can be put in containers of many books, it keeps weak references to the containers."""
+
+    def _init_item(self):
+        self._owners = []
+        self._told = None
+
+    def _add_owner(self, owner):
+        self._owners.append(weakref.ref(owner))
+
+    def _remove_owner(self, owner):
+        for i, ref in enumerate(self._owners):
+            if ref() is owner:
+                del self._owners[i]
+                return
+
+    def __getstate__(self):
+        # sent to worker processes without the containers
+        state = self.__dict__.copy()
+        state['_owners'] = []
+        return state
+
+
 class Metadata(List):
     """list-like.
 
@@ -41,14 +110,98 @@ class Files(Dict):
     """dict-like.
 
     Store file path and :class:`File` objects from `key` and `item`.
-    Any file you want to package them into the book, you have to use this."""
+    Any file you want to package them into the book, you have to use this.
+
+    Paths differ only in letter case are not allowed, some readers can't tell them apart.
+
+    Content of a :class:`File` is taken as unchanged, put a new :class:`File` here if it's changed."""
+    def __init__(self, *args, **kwargs):
+        self._registry = _PathRegistry()
+        self._version = 0
+        Dict.__init__(self, *args, **kwargs)
+
     def _before_add(self, key=None, item=None):
         if not isinstance(item, File):
             raise TypeError
 
+        if key in self._registry:
+            raise ValueError('{} collides with a path already in the book'.format(key))
+
+    def _after_add(self, key=None, item=None):
+        self._registry.add(key)
+        item._add_owner(self)
+        self._version += 1
+
+    def _after_del(self, key=None, item=None):
+        self._registry.remove(key)
+        item._remove_owner(self)
+        self._version += 1
+
+    def copy(self):
+        return Files(dict(self.items()))
+
+
+class _PathRegistry(object):
+    """Normalized paths of files in a book, for collision checks and new file names.
+
+    Paths are compared after normalizing separators and ``.`` and ``..`` parts, ignoring letter case."""
+    def __init__(self):
+        self._paths = {}
+        self._suffixes = {}
+
+    @staticmethod
+    def normalize(path):
+        path = posixpath.normpath(path.replace('\\', '/'))
+        return path.casefold() if hasattr(path, 'casefold') else path.lower()
+
+    def __contains__(self, path):
+        return self.normalize(path) in self._paths
+
+    def add(self, path):
+        normalized = self.normalize(path)
+        self._paths[normalized] = self._paths.get(normalized, 0) + 1
+
+    def remove(self, path):
+        normalized = self.normalize(path)
+        if self._paths[normalized] > 1:
+            self._paths[normalized] -= 1
+        else:
+            del self._paths[normalized]
+
+            # a freed name_n.ext is the first unused suffix again, so new names don't depend on the edit order
+            only_name, ext = posixpath.splitext(normalized)
+            name, sep, number = only_name.rpartition('_')
+            if sep and number.isdigit() and not number.startswith('0'):
+                key = name + ext
+                if self._suffixes.get(key, 0) >= int(number):
+                    self._suffixes[key] = int(number) - 1
+
+    def unused_path(self, path):
+        """
+        :param path: wanted path
+        :type path: str
+        :return: path itself if not used, else the first unused of name_1.ext, name_2.ext ...
+        :rtype: str
+        """
+        if path not in self:
+            return path
+
+        only_name, ext = posixpath.splitext(path)
+        key = self.normalize(path)
+
+        # suffixes up to this were taken last time, start after them
+        i = self._suffixes.get(key, 0)
+        new_path = path
+        while new_path in self:
+            i += 1
+            new_path = '{}_{}{}'.format(only_name, i, ext)
+        self._suffixes[key] = i - 1
 
-class File(object):
-    def __init__(self, binary, mime=None, fallback=None):
+        return new_path
+
+
+class File(_Item):
+    def __init__(self, binary, mime=None, fallback=None, compress_type=None):
         """
         :param binary: binary data
         :type binary: bytes
@@ -56,18 +209,371 @@ class File(object):
         :type mime: str
         :param fallback: file path
         :type fallback: str
+        :param compress_type: zipfile.ZIP_STORED or zipfile.ZIP_DEFLATED, decided by the media type if None,
+         see :class:`epubaker.compression.CompressionPolicy`
+        :type compress_type: int
         """
 
         self._binary = binary
-        self.mime = mime
+        self._mime = mime
         # self.identification = identification or 'id_' + uuid.uuid4().hex
-        self.fallback = fallback
+        self._fallback = fallback
+        self.compress_type = compress_type
+
+        self._init_item()
+
+    @classmethod
+    def from_path(cls, path, mime=None, fallback=None, compress_type=None):
+        """File reads from a path on disk, nothing is read until the data is needed.
+
+        :param path: path on disk
+        :type path: str
+        :param mime: mime
+        :type mime: str
+        :param fallback: file path
+        :type fallback: str
+        :param compress_type: see :class:`File`
+        :type compress_type: int
+        :rtype: File
+        """
+        return _PathFile(path, mime=mime, fallback=fallback, compress_type=compress_type)
+
+    @classmethod
+    def from_mmap(cls, mm, mime=None, fallback=None, compress_type=None):
+        """File reads from a memory map, or any other object supports the buffer protocol, without copy.
+
+        :param mm: object of :class:`mmap.mmap`
+        :param mime: mime
+        :type mime: str
+        :param fallback: file path
+        :type fallback: str
+        :param compress_type: see :class:`File`
+        :type compress_type: int
+        :rtype: File
+        """
+        return _MmapFile(mm, mime=mime, fallback=fallback, compress_type=compress_type)
+
+    @classmethod
+    def from_callable(cls, func, mime=None, fallback=None, size=None, compress_type=None):
+        """File reads from what the func returns, func is called every time the data is needed.
+
+        :param func: callable with no arguments, returns a binary file-like object, it will be closed after reading
+        :param mime: mime
+        :type mime: str
+        :param fallback: file path
+        :type fallback: str
+        :param size: length of the data, if you know it
+        :type size: int
+        :param compress_type: see :class:`File`
+        :type compress_type: int
+        :rtype: File
+        """
+        return _CallableFile(func, mime=mime, fallback=fallback, size=size, compress_type=compress_type)
+
+    @property
+    def mime(self):
+        """as class parameter"""
+        return self._mime
+
+    @mime.setter
+    def mime(self, value):
+        self._mime = value
+        _item_changed(self)
+
+    @property
+    def fallback(self):
+        """as class parameter"""
+        return self._fallback
+
+    @fallback.setter
+    def fallback(self, value):
+        self._fallback = value
+        _item_changed(self)
 
     @property
     def binary(self):
         """as class parmeter"""
         return self._binary
 
+    @property
+    def size(self):
+        """length of the data in bytes, None if unknown"""
+        return len(self._binary)
+
+    def open(self):
+        """
+        :return: binary file-like object to read the data, close it after use
+        """
+        return io.BufferedReader(_MemoryReader(self._binary))
+
+    def iter_chunks(self, chunk_size=CHUNK_SIZE):
+        """Yield the data piece by piece, no copy is made.
+
+        :param chunk_size: max length of every piece
+        :type chunk_size: int
+        """
+        data = memoryview(self._binary)
+        for i in range(0, len(data), chunk_size):
+            yield data[i:i + chunk_size]
+
+    def _picklable(self):
+        """
+        :return: this file to send to worker processes, which read the data there, None if it can't be pickled
+        """
+        return self
+
+    def _content_stamp(self):
+        """
+        :return: changes if the content may be changed, data in memory is taken as unchanged
+        """
+        return None
+
+
+class _PathFile(File):
+    def __init__(self, path, mime=None, fallback=None, compress_type=None):
+        File.__init__(self, None, mime=mime, fallback=fallback, compress_type=compress_type)
+        self._path = path
+
+    @property
+    def binary(self):
+        with open(self._path, 'rb') as f:
+            return f.read()
+
+    @property
+    def size(self):
+        return os.path.getsize(self._path)
+
+    def open(self):
+        return open(self._path, 'rb')
+
+    def _content_stamp(self):
+        stat = os.stat(self._path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def iter_chunks(self, chunk_size=CHUNK_SIZE):
+        with self.open() as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                yield chunk
+
+
+class _MmapFile(File):
+    def __init__(self, mm, mime=None, fallback=None, compress_type=None):
+        File.__init__(self, mm, mime=mime, fallback=fallback, compress_type=compress_type)
+
+    @property
+    def binary(self):
+        return bytes(memoryview(self._binary))
+
+    def _picklable(self):
+        # a memory map can't be sent, and copying it would read all of it in this process
+        return None
+
+
+class _CallableFile(File):
+    def __init__(self, func, mime=None, fallback=None, size=None, compress_type=None):
+        File.__init__(self, None, mime=mime, fallback=fallback, compress_type=compress_type)
+        self._func = func
+        self._size = size
+
+    @property
+    def binary(self):
+        with self.open() as f:
+            return f.read()
+
+    @property
+    def size(self):
+        return self._size
+
+    def open(self):
+        return self._func()
+
+    def _content_stamp(self):
+        # nothing tells whether what func returns is changed, never the same as last time
+        return object()
+
+    def _picklable(self):
+        try:
+            pickle.dumps(self._func)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            # lambdas, local functions and the like
+            return None
+        return self
+
+    def iter_chunks(self, chunk_size=CHUNK_SIZE):
+        with self.open() as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                yield chunk
+
+
+class _MemoryReader(io.RawIOBase):
+    """Raw reader over bytes, mmap and the like, reads go straight into the caller's buffer."""
+    def __init__(self, data):
+        io.RawIOBase.__init__(self)
+        self._data = memoryview(data).cast('B')
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = max(0, min(len(b), len(self._data) - self._pos))
+        b[:n] = self._data[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = len(self._data) + offset
+        else:
+            raise ValueError('invalid whence ({})'.format(whence))
+
+        if self._pos < 0:
+            raise ValueError('negative seek position {}'.format(self._pos))
+
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self._data.release()
+        io.RawIOBase.close(self)
+
+
+class ManifestItem(object):
+    """A file in the manifest, made into an item element only when the opf is built as a tree."""
+    __slots__ = ('href', 'media_type', 'id', 'fallback', 'properties')
+
+    def __init__(self, href, media_type, id_, fallback=None):
+        self.href = href
+        self.media_type = media_type
+        self.id = id_
+
+        self.fallback = fallback
+        """id of the fallback item, or None"""
+
+        self.properties = None
+        """properties separated by spaces, or None"""
+
+    @property
+    def attributes(self):
+        """attributes of the item element, in the order they are written
+
+        :rtype: dict
+        """
+        attributes = {(None, 'href'): self.href, (None, 'media-type'): self.media_type, (None, 'id'): self.id}
+
+        if self.fallback is not None:
+            attributes[(None, 'fallback')] = self.fallback
+
+        if self.properties:
+            attributes[(None, 'properties')] = self.properties
+
+        return attributes
+
+
+class Manifest(object):
+    """Manifest items, with indexes of them by path and by id."""
+    def __init__(self):
+        self.rows = []
+        """list of :class:`ManifestItem`, in the order they are written"""
+
+        self.ids = {}
+        """dict, file path to item id"""
+
+        self.items = {}
+        """dict, item id to :class:`ManifestItem`"""
+
+        self.media_types = {}
+        """dict, media type to ids of items, in manifest order"""
+
+        self._id_counters = {}
+
+    @property
+    def element(self):
+        """Manifest element of the items, a new one every time
+
+        :rtype: Element
+        """
+        element = Element('manifest')
+        for item in self.rows:
+            element.children.append(Element('item', attributes=item.attributes))
+
+        return element
+
+    def _new_id(self, path):
+        identification = xml_identify(path)
+        new_id = identification
+
+        i = self._id_counters.get(identification, 0)
+        while new_id in self.items:
+            i += 1
+            new_id = identification + '_' + str(i)
+        self._id_counters[identification] = i
+
+        return new_id
+
+    def add(self, path, file_):
+        """Make an item for the file and append it, fallback of the file has to be added before.
+
+        :param path: file path
+        :type path: str
+        :param file_: object of :class:`File`
+        :return: the item
+        :rtype: ManifestItem
+        """
+        media_type = file_.mime or mimes.map_from_extension[os.path.splitext(path)[1]]
+
+        fallback = self.ids[file_.fallback] if file_.fallback is not None else None
+
+        item = ManifestItem(path, media_type, self._new_id(path), fallback)
+
+        self.ids[path] = item.id
+        self.items[item.id] = item
+        self.media_types.setdefault(media_type, []).append(item.id)
+        self.rows.append(item)
+
+        return item
+
+
+def _fallback_order(files):
+    """
+    :param files: object of :class:`Files`
+    :return: file paths, in the order of files, but any fallback comes before files fall back to it
+    :rtype: list
+    """
+    order = []
+    done = set()
+
+    for path in files.keys():
+        chain = []
+        chain_set = set()
+
+        # walk to the end of the fallback chain, or to a file done already
+        while path is not None and path not in done:
+            if path in chain_set:
+                raise ValueError('fallback chain of {} is a loop'.format(path))
+
+            if path not in files:
+                raise ValueError('fallback {} of {} is not in files'.format(path, chain[-1]))
+
+            chain.append(path)
+            chain_set.add(path)
+            path = files[path].fallback
+
+        for one in reversed(chain):
+            order.append(one)
+            done.add(one)
+
+    return order
+
 
 ########################################################################################################################
 # Spine Joint
@@ -79,13 +585,32 @@ class Spine(List):
 
     store :class:`Joint` objects.
     """
+    _version = 0
 
     def _before_add(self, key=None, item=None):
         if not isinstance(item, Joint):
             raise TypeError
 
+    def _after_add(self, key=None, item=None):
+        item._add_owner(self)
+        self._version += 1
+
+    def _after_del(self, key=None, item=None):
+        for one in _hooked_items(key, item):
+            one._remove_owner(self)
+        self._version += 1
 
-class Joint:
+    # items are reordered in place, no hook is called for that
+    def reverse(self):
+        List.reverse(self)
+        self._version += 1
+
+    def sort(self, *args, **kwargs):
+        List.sort(self, *args, **kwargs)
+        self._version += 1
+
+
+class Joint(_Item):
     def __init__(self, path, linear=None):
         """
         :param path: file path, in Epub.Files.keys()
@@ -94,13 +619,25 @@ class Joint:
         :type linear: bool
         """
         self._path = path
-        self.linear = linear
+        self._linear = linear
+
+        self._init_item()
 
     @property
     def path(self):
         """as class parmeter"""
         return self._path
 
+    @property
+    def linear(self):
+        """as class parameter"""
+        return self._linear
+
+    @linear.setter
+    def linear(self, value):
+        self._linear = value
+        _item_changed(self)
+
 
 ########################################################################################################################
 # TOC Section
@@ -112,12 +649,14 @@ class Toc(List):
 
     store :class:`Section` objects.
     """
+    _version = 0
 
     def __init__(self):
         List.__init__(self)
 
         self.title = 'Table of Contents'
 
+        # -1 or None for the depth of the deepest section
         self.ncx_depth = -1
         self.ncx_totalPageCount = -1
         self.ncx_maxPageNumber = -1
@@ -126,14 +665,57 @@ class Toc(List):
         if not isinstance(item, Section):
             raise TypeError
 
+    def _after_add(self, key=None, item=None):
+        item._add_owner(self)
+        self._version += 1
+
+    def _after_del(self, key=None, item=None):
+        for one in _hooked_items(key, item):
+            one._remove_owner(self)
+        self._version += 1
+
+    # items are reordered in place, no hook is called for that
+    def reverse(self):
+        List.reverse(self)
+        self._version += 1
+
+    def sort(self, *args, **kwargs):
+        List.sort(self, *args, **kwargs)
+        self._version += 1
+
 
 class _SubSections(List):
+    def __init__(self, section):
+        """
+        :param section: the Section these are sub sections of, changes are passed up to it
+        :type section: Section
+        """
+        self._section = section
+        List.__init__(self)
+
     def _before_add(self, key=None, item=None):
         if not isinstance(item, Section):
             raise TypeError
 
+    def _after_add(self, key=None, item=None):
+        item._add_owner(self)
+        _item_changed(self._section)
+
+    def _after_del(self, key=None, item=None):
+        for one in _hooked_items(key, item):
+            one._remove_owner(self)
+        _item_changed(self._section)
 
-class Section(object):
+    def reverse(self):
+        List.reverse(self)
+        _item_changed(self._section)
+
+    def sort(self, *args, **kwargs):
+        List.sort(self, *args, **kwargs)
+        _item_changed(self._section)
+
+
+class Section(_Item):
     """
     Store title, href and sub :class:`Section` objects.
     """
@@ -145,9 +727,11 @@ class Section(object):
         :param href: html link to a file path in :class:`Epub.files`, can have a bookmark. example: `text/a.html#hello`
         :type href: str
         """
+        self._init_item()
+
         self._title = title
         self._href = href
-        self._subs = _SubSections()
+        self._subs = _SubSections(self)
         self._hidden_subs = None
 
     @property
@@ -158,6 +742,7 @@ class Section(object):
     @title.setter
     def title(self, value):
         self._title = value
+        _item_changed(self)
 
     @property
     def href(self):
@@ -167,6 +752,7 @@ class Section(object):
     @href.setter
     def href(self, value):
         self._href = value
+        _item_changed(self)
 
     @property
     def subs(self):
@@ -190,6 +776,7 @@ class Section(object):
             raise ValueError
         else:
             self._hidden_subs = value
+            _item_changed(self)
 
 
 ########################################################################################################################
@@ -209,9 +796,23 @@ class Epub(object):
         # for opf etc.
         self._temp_files = Files()
         setattr(self._temp_files, '_epub', self)
+        # one registry for both, temp files must not collide with files
+        self._temp_files._registry = self._files._registry
 
         self._toc = Toc()
 
+        self.xml_indent = 4
+        """Indent generated documents like opf, nav and ncx by this many spaces, None to write them compact, without
+        whitespaces between elements."""
+
+        self.opf_tree = False
+        """Build opf as a tree of metadata, manifest and spine elements, for subclasses those change the elements,
+        see :meth:`_make_opf_bytes`. Else manifest items and spine itemrefs are written directly, it is faster for big
+        books and gives the same opf."""
+
+        # generated documents and elements, name: (key, value), see _cached
+        self._cache = {}
+
     metadata = property(lambda self: self._metadata, doc=str(Metadata.__doc__ if Metadata.__doc__ else ''))
 
     files = property(lambda self: self._files, doc=str(Files.__doc__ if Files.__doc__ else ''))
@@ -221,13 +822,14 @@ class Epub(object):
     toc = property(lambda self: self._toc, doc=str(Toc.__doc__ if Toc.__doc__ else ''))
 
     @staticmethod
-    def _find_ncx_id(items):
-        ncx_id = None
-        for item in items:
-            if item.attributes[(None, 'media-type')] == mimes.NCX:
-                ncx_id = item.attributes[(None, 'id')]
-                break
-        return ncx_id
+    def _find_ncx_id(manifest):
+        """
+        :param manifest: object of :class:`Manifest`
+        :return: id of the first ncx item
+         :rtype: str or None
+        """
+        ncx_ids = manifest.media_types.get(mimes.NCX)
+        return ncx_ids[0] if ncx_ids else None
 
     def _find_unique_id(self):
         """
@@ -239,12 +841,68 @@ class Epub(object):
                 return m.to_element().attributes[(None, 'id')]
         return None
 
-    def _find_id(self, filepath):
-        for item in self._make_manifest_element().children:
-            if item.attributes[(None, 'href')] == filepath:
-                return item.attributes[(None, 'id')]
+    def _find_identifier_text(self):
+        """
+        :return: text of the first Identifier in metadata
+         :rtype: str or None
+        """
+        for m in self.metadata:
+            if isinstance(m, Identifier):
+                return m.text
         return None
 
+    def _cached(self, name, key, make):
+        """Return what make() returned last time if key is the same, else call make() again.
+
+        Keys are made of the _version of the containers, those change whenever the books is changed, so only the
+        documents depend on the changed part are made again.
+        """
+        cached = self._cache.get(name)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        value = make()
+        self._cache[name] = (key, value)
+        return value
+
+    def _files_key(self):
+        _epoch[0] += 1
+        return self._files._version, tuple(self._temp_files.keys())
+
+    def _contents_key(self):
+        """
+        :return: key of what the files read from disk or from callables have now, for caches depend on the content
+         :rtype: tuple
+        """
+        return tuple(file_._content_stamp() for file_ in self._files.values())
+
+    def _spine_key(self):
+        _epoch[0] += 1
+        return self._spine._version
+
+    def _toc_key(self):
+        _epoch[0] += 1
+        return (self._toc._version, self._toc.title,
+                self._toc.ncx_depth, self._toc.ncx_totalPageCount, self._toc.ncx_maxPageNumber)
+
+    def _get_ncx_data(self):
+        """
+        :return: ncx document, from the cache if toc is not changed
+         :rtype: bytes
+        """
+        return self._cached('ncx', (self._toc_key(), self._find_identifier_text(), self.xml_indent),
+                            lambda: Xl(root=self._make_ncx_element()).to_bytes(indent=self.xml_indent))
+
+    def _find_id(self, filepath, manifest=None):
+        """
+        :param filepath: file path
+        :param manifest: object of :class:`Manifest` of this build, made if None
+        :return: manifest item id of the file
+         :rtype: str or None
+        """
+        manifest = manifest or self._make_manifest()
+        return manifest.ids.get(filepath)
+
     def _make_ncx_element(self):
 
         ncx = Element('ncx',
@@ -255,15 +913,14 @@ class Epub(object):
 
         # same as dc:Identifier
 
-        identifier_text = None
-        for m in self.metadata:
-            if isinstance(m, Identifier):
-                identifier_text = m.text
-                break
+        head.children.append(Element('meta', attributes={'name': 'dtb:uid', 'content': self._find_identifier_text()}))
+
+        nav_map, depth = self._get_toc_elements()[1:]
 
-        head.children.append(Element('meta', attributes={'name': 'dtb:uid', 'content': identifier_text}))
+        if self.toc.ncx_depth not in (-1, None):
+            depth = self.toc.ncx_depth
 
-        head.children.append(Element('meta', attributes={'name': 'dtb:depth', 'content': self.toc.ncx_depth}))
+        head.children.append(Element('meta', attributes={'name': 'dtb:depth', 'content': depth}))
 
         head.children.append(Element('meta', attributes={'name': 'dtb:totalPageCount',
                                                          'content': self.toc.ncx_totalPageCount}))
@@ -282,115 +939,105 @@ class Epub(object):
 
         text.children.append(self.toc.title)
 
-        nav_map = Element('navMap')
         ncx.children.append(nav_map)
 
-        def make_nav_point(sec):
-            nav_point = Element('navPoint', attributes={'id': 'id_' + uuid.uuid4().hex})
-
-            nav_label = Element('navLabel')
-            nav_point.children.append(nav_label)
-
-            text_ = Element('text')
-            nav_label.children.append(text_)
-
-            text_.children.append(sec.title)
-
-            content = Element('content')
-            nav_point.children.append(content)
-
-            first_sub = None
-            for subsection in sec.subs:
-                sub = make_nav_point(subsection)
-                nav_point.children.append(sub)
-
-                first_sub = first_sub or sub
+        return ncx
 
-            if sec.href:
-                content.attributes[(None, 'src')] = sec.href
+    def _get_toc_elements(self):
+        """
+        :return: see :func:`_make_toc_elements`, from the cache if toc is not changed
+         :rtype: tuple
+        """
+        return self._cached('toc', self._toc_key(), lambda: _make_toc_elements(self.toc))
 
-            elif first_sub:
-                content.attributes[(None, 'src')] = first_sub.children[1].attributes[(None, 'src')]
+    def _make_manifest(self):
+        """
+        :return: Manifest with indexes of the items
+         :rtype: Manifest
+        """
+        manifest = Manifest()
 
-                #
-            return nav_point
+        for _path in _fallback_order(self.files):
+            manifest.add(_path, self.files[_path])
 
-        for _sec in self.toc:
-            nav_map.children.append(make_nav_point(_sec))
+        for _path, _file in self._temp_files.items():
+            manifest.add(_path, _file)
 
-        return ncx
-        # return pretty_insert(ncx, dont_do_when_one_child=True).string()
+        return manifest
 
     def _make_manifest_element(self):
         """
         :return: Manifest Element
          :rtype: Element
         """
-        manifest = Element('manifest')
-
-        ids = []
-
-        item_dict = {}
-
-        pathes = list(self.files.keys())
-
-        def make_item(path, file_):
-            item = Element('item', attributes={(None, 'href'): path})
-
-            item.attributes[(None, 'media-type')] = file_.mime or mimes.map_from_extension[
-                os.path.splitext(path)[1]]
+        return self._make_manifest().element
 
-            identification = xml_identify(path)
-            new_id = identification
-            i = 1
-            while new_id in ids:
-                new_id = identification + '_' + str(i)
+    def _make_spine_rows(self, manifest):
+        """
+        :param manifest: object of :class:`Manifest` of this build
+        :return: (idref, linear) of every itemref, linear is None if not given
+         :rtype: list
+        """
+        rows = []
+        for joint in self.spine:
+            if joint.linear is True:
+                linear = 'yes'
+            elif joint.linear is False:
+                linear = 'no'
+            else:
+                linear = None
 
-            item.attributes[(None, 'id')] = new_id
-            ids.append(new_id)
+            rows.append((manifest.ids.get(joint.path), linear))
 
-            return item
+        return rows
 
-        while pathes:
-            for _path in pathes:
-                if self.files[_path].fallback is not None:
-                    if self.files[_path].fallback in item_dict.keys():
-                        _item = make_item(_path, self.files[_path])
-                        _item.attributes[(None, 'fallback')] = item_dict[_path].attributes[(None, 'id')]
-                        item_dict[_path] = _item
+    def _make_spine_element(self, manifest=None):
+        """
+        :param manifest: object of :class:`Manifest` of this build, made if None
+        :return: Spine Element
+         :rtype: Element
+        """
+        manifest = manifest or self._make_manifest()
 
-                        manifest.children.append(_item)
-                        pathes.remove(_path)
-                else:
-                    _item = make_item(_path, self.files[_path])
-                    item_dict[_path] = _item
+        spine = Element('spine')
 
-                    manifest.children.append(_item)
-                    pathes.remove(_path)
+        for idref, linear in self._make_spine_rows(manifest):
 
-        for _path, _file in self._temp_files.items():
-            manifest.children.append(make_item(_path, _file))
+            itemref = Element('itemref', attributes={(None, 'idref'): idref})
 
-        return manifest
+            if linear is not None:
+                itemref.attributes[(None, 'linear')] = linear
 
-    def _make_spine_element(self):
-        spine = Element('spine')
+            spine.children.append(itemref)
 
-        for joint in self.spine:
+        return spine
 
-            itemref = Element('itemref', attributes={(None, 'idref'): self._find_id(joint.path)})
+    def _make_opf_bytes(self, package, metadata, manifest):
+        """
+        :param package: package element without children
+        :type package: Element
+        :param metadata: metadata element
+        :type metadata: Element
+        :param manifest: object of :class:`Manifest` of this build
+        :return: opf data, built as a tree if :attr:`opf_tree`, else written directly
+         :rtype: bytes
+        """
+        if self.opf_tree:
+            spine = self._make_spine_element(manifest)
+            # Find ncx id for spine
+            spine.attributes['toc'] = self._find_ncx_id(manifest)
 
-            if joint.linear is True:
-                itemref.attributes[(None, 'linear')] = 'yes'
-            elif joint.linear is False:
-                itemref.attributes[(None, 'linear')] = 'no'
+            package.children.extend([metadata, manifest.element, spine])
+            return Xl(root=package).to_bytes(indent=self.xml_indent)
 
-            spine.children.append(itemref)
+        pieces = iter_opf_pieces(package, metadata, manifest, self._make_spine_rows(manifest),
+                                 self._find_ncx_id(manifest), self.xml_indent)
 
-        return spine
+        # encoded as Xl.to_bytes does, opf has no header
+        return b''.join(iter_encoded(pieces))
 
     @staticmethod
-    def _get_container_xmlstring(opf_path):
+    def _get_container_data(opf_path, indent=4):
         e = Element('container')
 
         e.attributes['version'] = '1.0'
@@ -407,31 +1054,135 @@ class Epub(object):
 
         rootfile.attributes['media-type'] = 'application/oebps-package+xml'
 
-        return Xl(root=pretty_insert(e, dont_do_when_one_child=True)).string()
+        return Xl(root=e).to_bytes(indent=indent)
 
     def _get_unused_filename(self, dire, filename):
-        dire = dire or ''
+        """
+        :param dire: directory relative to the opf, None for the same directory
+        :param filename: wanted file name
+        :return: filename, or a name like it, not used by files and temp files
+         :rtype: str
+        """
+        dire = (dire or '').strip('/')
+
+        path = self._files._registry.unused_path(posixpath.join(dire, filename) if dire else filename)
 
-        only_name, ext = os.path.splitext(filename)
-        unused_filename = filename
+        return posixpath.basename(path)
 
-        while ROOT_OF_OPF + dire + '/' + unused_filename in [ROOT_OF_OPF + '/' + path for path in self.files.keys()] +\
-                [ROOT_OF_OPF + '/' + path for path in self._temp_files.keys()]:
+    @abstractmethod
+    def _make_opf_data(self):
+        """Put generated documents like nav and ncx to temp files.
 
-            unused_filename = '_{}{}'.format(
-                random.random(''.join(random.sample(string.ascii_letters + string.digits, 8))),
-                ext
-            )
+        :return: opf data
+        :rtype: bytes
+        """
 
-        return unused_filename
+    def _iter_write(self, fileobj, workers=None, executor='thread', policy=None, cache=None, base=None):
+        """Write the book to fileobj, yield after every chunk, so the caller can take the written bytes away."""
+        base = _existing_base(base)
+        base_reader = ZipReader(base) if base is not None else None
+        try:
+            opf_data = self._make_opf_data()
+            opf_filename = self._get_unused_filename(None, 'package.opf')
 
-    @abstractmethod
-    def write(self, filename):
+            container_data = self._get_container_data(ROOT_OF_OPF + '/' + opf_filename, self.xml_indent)
+
+            z = ZipWriter(fileobj)
+
+            # write mimetype as first file in zip
+            z.writestr('mimetype', 'application/epub+zip'.encode('ascii'), compress_type=ZIP_STORED)
+            yield
+
+            # write custom files and temp files
+            policy = policy or CompressionPolicy()
+            entries = ((ROOT_OF_OPF + '/' + filename, fil, policy.compress_type(filename, fil))
+                       for filename, fil in itertools.chain(self.files.items(), self._temp_files.items()))
+
+            with Compressor(workers=workers, executor=executor, cache=cache, base=base_reader) as compressor:
+                for _ in compressor.write_entries(z, entries):
+                    yield
+
+            # write opf data
+            z.writestr(ROOT_OF_OPF + '/' + opf_filename, opf_data, ZIP_DEFLATED)
+
+            # write container
+            z.writestr(CONTAINER_PATH, container_data, ZIP_DEFLATED)
+
+            z.close()
+            yield
+
+        finally:
+            self._temp_files.clear()
+            if base_reader:
+                base_reader.close()
+
+    def write(self, filename, workers=None, executor='thread', policy=None, cache=None, base=None):
         """Write to file.
 
         :param filename: file name.
         :type filename: str
+        :param workers: number of workers to compress files concurrently, None or 1 to compress one by one
+        :type workers: int
+        :param executor: 'thread' or 'process' for the workers, or a :class:`concurrent.futures.Executor` to use.
+         zlib releases the GIL, so 'thread' is good on CPython
+        :param policy: decides which files to compress, default stores images, fonts and audio those are
+         compressed already without compressing them again
+        :type policy: epubaker.compression.CompressionPolicy
+        :param cache: reuse compressed files of earlier builds instead of compressing them again
+        :type cache: epubaker.cache.EntryCache
+        :param base: path or seekable file-like object of an earlier build of this book. Files not changed since
+         then are copied from it as they are, only changed files are compressed. It can be the same as filename,
+         a path which doesn't exist yet means a full build
         """
+        # checked before filename is opened, which makes it exist when they are the same
+        base = _existing_base(base)
+        options = dict(workers=workers, executor=executor, policy=policy, cache=cache, base=base)
+
+        if base is not None and not hasattr(base, 'read') and os.path.exists(filename) \
+                and os.path.samefile(base, filename):
+            # base is read while writing, don't overwrite it until done
+            tmp_filename = '{}.{}.tmp'.format(filename, uuid.uuid4().hex)
+            try:
+                with open(tmp_filename, 'wb') as f:
+                    self.write_to(f, **options)
+                os.replace(tmp_filename, filename)
+            finally:
+                if os.path.exists(tmp_filename):
+                    os.remove(tmp_filename)
+
+        else:
+            with open(filename, 'wb') as f:
+                self.write_to(f, **options)
+
+    def write_to(self, fileobj, **options):
+        """Write to a file-like object, it only needs a ``write`` method, no seek or tell, so a socket file or a pipe
+        is fine. Files are written piece by piece, memory use doesn't grow with the book.
+
+        :param fileobj: file-like object
+        :param options: same as :meth:`write`
+        """
+        for _ in self._iter_write(fileobj, **options):
+            pass
+
+    def iter_bytes(self, chunk_size=CHUNK_SIZE, **options):
+        """Yield the book as bytes pieces, every piece is chunk_size long except the last one.
+
+        Useful for web frameworks those take an iterable as response body.
+
+        :param chunk_size: length of pieces
+        :type chunk_size: int
+        :param options: same as :meth:`write`
+        :rtype: bytes
+        """
+        sink = _ChunkSink(chunk_size)
+
+        for _ in self._iter_write(sink, **options):
+            for chunk in sink.pop_chunks():
+                yield chunk
+
+        rest = sink.pop_rest()
+        if rest:
+            yield rest
 
     ####################################################################################################################
     # Add-ons
@@ -448,9 +1199,11 @@ class Epub(object):
         :rtype: File
         """
 
-        img = Image.open(io.BytesIO(self.files[image_path].binary))
-        width = width or img.size[0]
-        height = heigth or img.size[1]
+        with self.files[image_path].open() as f:
+            # Image.open only reads the header here
+            img = Image.open(f)
+            width = width or img.size[0]
+            height = heigth or img.size[1]
 
         relative = relative_path(os.path.split(cover_page_path or '')[0], image_path)
 
@@ -460,6 +1213,128 @@ class Epub(object):
         return File(cover_page)
 
 
+class _ChunkSink(object):
+    """File-like object for :meth:`Epub.iter_bytes`, cut written data into fixed length pieces."""
+    def __init__(self, chunk_size):
+        self._chunk_size = chunk_size
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self._buffer += data
+
+    def pop_chunks(self):
+        chunks = []
+        while len(self._buffer) >= self._chunk_size:
+            chunks.append(bytes(self._buffer[:self._chunk_size]))
+            del self._buffer[:self._chunk_size]
+        return chunks
+
+    def pop_rest(self):
+        rest = bytes(self._buffer)
+        del self._buffer[:]
+        return rest
+
+
+def _existing_base(base):
+    """
+    :param base: base given to write, a path or file-like object
+    :return: base, or None if it is a path which doesn't exist, the first build has no earlier one
+    """
+    if base is not None and not hasattr(base, 'read') and not os.path.exists(base):
+        return None
+
+    return base
+
+
+def _make_toc_elements(toc):
+    """
+    Make elements of nav and ncx for the sections in one walk. It goes with a stack instead of recursion, so tocs of
+    any depth are made in linear time.
+
+    A section without href points to where its first sub section points. Sections point to the same place have the
+    same playOrder, numbered in the order they come.
+
+    :param toc: object of :class:`Toc`
+    :return: (ol element of nav, navMap element of ncx, depth of the deepest section)
+     :rtype: tuple
+    """
+    nav_ol = Element((None, 'ol'))
+    nav_map = Element('navMap')
+
+    depth = 0
+    play_orders = {}
+
+    # navPoints and contents of sections without href, each is the first sub section of the one before
+    waiting = []
+
+    # sections to do, ol and navMap or navPoint to put them in, depth of them
+    stack = [(iter(toc), nav_ol, nav_map, 1)]
+    while stack:
+        sections, ol, parent, level = stack[-1]
+
+        for sec in sections:
+            depth = max(depth, level)
+
+            li = Element((None, 'li'))
+            ol.children.append(li)
+
+            if sec.href:
+                a_or_span = Element((None, 'a'))
+                a_or_span.attributes[(None, 'href')] = sec.href
+            else:
+                a_or_span = Element((None, 'span'))
+
+            a_or_span.children.append(sec.title)
+
+            li.children.append(a_or_span)
+
+            nav_point = Element('navPoint', attributes={'id': 'id_' + uuid.uuid4().hex})
+            parent.children.append(nav_point)
+
+            nav_label = Element('navLabel')
+            nav_point.children.append(nav_label)
+
+            text = Element('text')
+            nav_label.children.append(text)
+
+            text.children.append(sec.title)
+
+            content = Element('content')
+            nav_point.children.append(content)
+
+            if sec.href:
+                play_order = str(play_orders.setdefault(sec.href, len(play_orders) + 1))
+
+                waiting.append((nav_point, content))
+                for nav_point_, content_ in waiting:
+                    nav_point_.attributes['playOrder'] = play_order
+                    content_.attributes[(None, 'src')] = sec.href
+                waiting = []
+
+            elif sec.subs:
+                waiting.append((nav_point, content))
+
+            else:
+                # points to nowhere, so do those waiting
+                waiting = []
+
+            if sec.subs:
+                sub_ol = Element((None, 'ol'))
+
+                if sec.hidden_subs:
+                    sub_ol.attributes[(None, 'hidden')] = ''
+
+                li.children.append(sub_ol)
+
+                stack.append((iter(sec.subs), sub_ol, nav_point, level + 1))
+                break
+
+        else:
+            stack.pop()
+
+    return nav_ol, nav_map, depth
+
+
 def xml_identify(s):
     """
     :param s:
@@ -2,21 +2,20 @@
 
 from __future__ import unicode_literals
 
-import zipfile
-
-import html5lib
 import io
 import os
 
 
-from epubaker.epub import Epub, File, OPF_NS, ROOT_OF_OPF, CONTAINER_PATH
+from epubaker.epub import Epub, File, OPF_NS
 
 from epubaker.metas.dcmes import URI_DC
 
-from epubaker.xl import Xl, Element, URI_XML, pretty_insert
+from epubaker.xl import Xl, Element, URI_XML
 
 from epubaker import mimes
 
+from epubaker.scanner import scan_files_properties
+
 
 XML_URI = 'http://www.w3.org/1999/xhtml'
 OPS_URI = 'http://www.idpf.org/2007/ops'
@@ -28,6 +27,12 @@ class Epub3(Epub):
 
         self._cover_image = None
 
+        # keeps properties of content documents between builds, see epubaker.stores
+        self.properties_store = None
+
+        # number of processes to scan content documents with, small books are scanned in process anyway
+        self.analysis_workers = None
+
     @property
     def cover_image(self):
         """Tag your cover image path as a cover"""
@@ -70,143 +75,90 @@ class Epub3(Epub):
         body = Element((None, 'body'))
         html.children.append(body)
 
-        def to_nav_li_element(sec):
-            li = Element((None, 'li'))
-
-            if sec.href:
-                a_or_span = Element((None, 'a'))
-                a_or_span.attributes[(None, 'href')] = sec.href
-            else:
-                a_or_span = Element((None, 'span'))
-
-            a_or_span.children.append(sec.title)
-
-            li.children.append(a_or_span)
-
-            if sec.subs:
-                _ol = Element((None, 'ol'))
-
-                if sec.hidden_subs:
-                    _ol.attributes[(None, 'hidden')] = ''
-
-                for one in sec.subs:
-                    _ol.children.append(to_nav_li_element(one))
-
-                li.children.append(_ol)
-
-            return li
-
         if self.toc:
             nav = Element((None, 'nav'), prefixes={OPS_URI: 'epub'}, attributes={(OPS_URI, 'type'): 'toc'})
-            ol = Element((None, 'ol'))
-
-            for section in self.toc:
-                ol.children.append(to_nav_li_element(section))
-
-            nav.children.append(ol)
+            nav.children.append(self._get_toc_elements()[0])
             body.children.append(nav)
 
         return html
 
     def _process_items_properties(self, manifest):
-        for item in manifest.children:
-            properties = []
-
-            if item.attributes[(None, 'media-type')] in (mimes.XHTML, mimes.HTML):
+        """
+        :param manifest: object of :class:`epubaker.epub.Manifest`, properties of its XHTML and HTML items are set
+        """
+        items = []
+        files = []
+        for item in manifest.rows:
+            if item.media_type in (mimes.XHTML, mimes.HTML):
 
                 try:
-                    html_string = self.files[item.attributes[(None, 'href')]].binary.decode()
+                    file_ = self.files[item.href]
                 except KeyError:
-                    html_string = self._temp_files[item.attributes[(None, 'href')]].binary.decode()
+                    file_ = self._temp_files[item.href]
 
-                if _has_element('script', html_string):
-                    properties.append('scripted')
+                items.append(item)
+                files.append(file_)
 
-                if _has_element('math', html_string):
-                    properties.append('mathml')
+        results = scan_files_properties(files, workers=self.analysis_workers, store=self.properties_store)
 
+        for item, properties in zip(items, results):
             if properties:
-                item.attributes[(None, 'properties')] = ' '.join(properties)
+                item.properties = ' '.join(properties)
+
+    def _get_nav_data(self):
+        """
+        :return: nav document, from the cache if toc is not changed
+         :rtype: bytes
+        """
+        return self._cached('nav', (self._toc_key(), self.xml_indent),
+                            lambda: Xl(root=self._make_nav_element()).to_bytes(indent=self.xml_indent))
 
-    def _get_opf_xmlstring(self, toc_path):
+    def _make_manifest_with_properties(self, toc_path):
+        manifest = self._make_manifest()
+        self._process_items_properties(manifest)
 
-        package = Element('package', prefixes={OPF_NS: None}, attributes={'version': '3.0'})
+        for path, property_ in ((toc_path, 'nav'), (self.cover_image, 'cover-image')):
+            if path in manifest.ids:
+                item = manifest.items[manifest.ids[path]]
+                item.properties = item.properties + ' ' + property_ if item.properties else property_
 
-        package.attributes[(URI_XML, 'lang')] = 'en'
+        return manifest
 
-        # unique - identifier = "pub-id"
-        if self._find_unique_id():
-            package.attributes['unique-identifier'] = self._find_unique_id()
+    def _get_opf_data(self, toc_path):
+        # properties come from the content of files, nav is scanned as well, it changes with toc
+        manifest_key = (self._files_key(), self._contents_key(), self._toc_key(), toc_path, self.cover_image)
+        spine_key = (self._spine_key(), manifest_key)
 
-        # Metadata
-        package.children.append(self._make_metadata_element())
+        # made once, for properties, spine and ncx id
+        manifest = self._cached('manifest', manifest_key, lambda: self._make_manifest_with_properties(toc_path))
 
-        # manifest
-        manifest = self._make_manifest_element()
-        package.children.append(manifest)
-        self._process_items_properties(manifest)
+        # meta objects can be changed in place, compare what they make
+        metadata = self._make_metadata_element()
 
-        for item in manifest.children:
-            if item.attributes[(None, 'href')] == toc_path:
-                item.attributes[(None, 'properties')] = 'nav'
+        def make_opf():
+            package = Element('package', prefixes={OPF_NS: None}, attributes={'version': '3.0'})
 
-            if item.attributes[(None, 'href')] == self.cover_image:
-                item.attributes[(None, 'properties')] = 'cover-image'
+            package.attributes[(URI_XML, 'lang')] = 'en'
 
-        # Find ncx id for spine
-        toc_ncx_item_e_id = self._find_ncx_id(manifest.children)
+            # unique - identifier = "pub-id"
+            if self._find_unique_id():
+                package.attributes['unique-identifier'] = self._find_unique_id()
 
-        # Spine
-        spine = self._make_spine_element()
-        package.children.append(spine)
-        spine.attributes['toc'] = toc_ncx_item_e_id
+            return self._make_opf_bytes(package, metadata, manifest)
 
-        return Xl(root=pretty_insert(package, dont_do_when_one_child=True)).string()
+        return self._cached('opf', (metadata.string(), spine_key, self.xml_indent, self.opf_tree), make_opf)
 
-    def write(self, filename):
+    def _make_opf_data(self):
 
         # put nav to temp files
-        nav_xmlstring = pretty_insert(self._make_nav_element(), dont_do_when_one_child=True).string()
         toc_nav_path = self._get_unused_filename(None, 'nav.xhtml')
-        self._temp_files[toc_nav_path] = File(nav_xmlstring.encode(), mime='application/xhtml+xml')
+        self._temp_files[toc_nav_path] = File(self._get_nav_data(), mime='application/xhtml+xml')
 
         # put ncx to temp files
-        ncx_xmlstring = pretty_insert(self._make_ncx_element(), dont_do_when_one_child=True).string()
         toc_ncx_filename = self._get_unused_filename(None, 'toc.ncx')
-        self._temp_files[toc_ncx_filename] = File(ncx_xmlstring.encode(), mime='application/x-dtbncx+xml')
-
-        # get opf name & data
-        opf_data = self._get_opf_xmlstring(toc_nav_path).encode()
-        opf_filename = self._get_unused_filename(None, 'package.opf')
-
-        # get container data
-        container_data = self._get_container_xmlstring(ROOT_OF_OPF + '/' + opf_filename).encode()
-
-        # make zipfile
-        z = zipfile.ZipFile(filename, 'w', compression=zipfile.ZIP_DEFLATED)
-
-        # write mimetype as first file in zip
-        z.writestr('mimetype', 'application/epub+zip'.encode('ascii'), compress_type=zipfile.ZIP_STORED)
-
-        # wirte files
-        for filename, _file in self.files.items():
-            z.writestr(ROOT_OF_OPF + os.sep + filename, _file.binary, zipfile.ZIP_DEFLATED)
-
-        # write temp files
-        for filename, _file in self._temp_files.items():
-            z.writestr(ROOT_OF_OPF + os.sep + filename, _file.binary, zipfile.ZIP_DEFLATED)
+        self._temp_files[toc_ncx_filename] = File(self._get_ncx_data(), mime='application/x-dtbncx+xml')
 
-        # write opf data
-        z.writestr(ROOT_OF_OPF + '/' + opf_filename, opf_data, zipfile.ZIP_DEFLATED)
-
-        # write container
-        z.writestr(CONTAINER_PATH, container_data, zipfile.ZIP_DEFLATED)
-
-        z.close()
-
-        self._temp_files.clear()
-
-    write.__doc__ = Epub.write.__doc__
+        return self._get_opf_data(toc_nav_path)
 
     ####################################################################################################################
     # Add-ons
@@ -222,16 +174,8 @@ class Epub3(Epub):
 
         html = self._make_nav_element()
 
-        def find_element_by_name(tag):
-            e = None
-            for one in html.children:
-                if one.tag == tag:
-                    return one
-
-            return e
-
-        head = find_element_by_name((None, 'head'))
-        body = find_element_by_name((None, 'body'))
+        head = html.find('head')
+        body = html.find('body')
 
         css_string = open(os.path.join(_dirt(__file__), 'static', 'user_toc_nav.css')).read()
         css = Element('style', attributes={'type': 'text/css'})
@@ -249,19 +193,9 @@ class Epub3(Epub):
         script_before_body_close.children.append('set_button();')
         body.children.append(script_before_body_close)
 
-        toc_page = pretty_insert(html).string().encode()
+        toc_page = Xl(root=html).to_bytes(indent=self.xml_indent)
         return File(toc_page)
 
 
-def _has_element(tag, file_string):
-    parser = html5lib.HTMLParser(tree=html5lib.getTreeBuilder('dom'))
-    minidom_docment = parser.parse(file_string)
-
-    if minidom_docment.getElementsByTagName(tag):
-        return True
-    else:
-        return False
-
-
 def _dirt(_file):
     return os.path.dirname(_file)
@@ -31,7 +31,7 @@ FONT_WOFF2 = 'font/woff2'  # ['.woff2'], 'Fonts'],
 
 map_from_extension = {
     '.gif': GIF,
-    '.jpg''.jpeg': JPEG, '.jpeg': JPEG,
+    '.jpg': JPEG, '.jpeg': JPEG,
     '.png': PNG,
     '.svg': SVG,
 
@@ -0,0 +1,89 @@
+# coding=utf-8
+
+"""
+Write the package document straight from the manifest and spine of a book.
+
+Manifest items and spine itemrefs are most of a big opf, they are written as rows of text here, no element is made for
+them. What is written is the same as serializing the package element with metadata, manifest and spine elements as
+children, see :meth:`epubaker.xl.Element.string`.
+"""
+
+from epubaker.xl import start_tag, escape_attribute
+
+
+def _item_string(item):
+    pieces = ['<item href="', escape_attribute(item.href),
+              '" media-type="', escape_attribute(item.media_type),
+              '" id="', escape_attribute(item.id), '"']
+
+    if item.fallback is not None:
+        pieces.extend([' fallback="', escape_attribute(item.fallback), '"'])
+
+    if item.properties:
+        pieces.extend([' properties="', escape_attribute(item.properties), '"'])
+
+    pieces.append(' />')
+    return ''.join(pieces)
+
+
+def _itemref_string(idref, linear):
+    if linear is None:
+        return '<itemref idref="{}" />'.format(escape_attribute(idref))
+
+    return '<itemref idref="{}" linear="{}" />'.format(escape_attribute(idref), escape_attribute(linear))
+
+
+def _iter_rows(start, end, rows, line, row_line):
+    if not rows:
+        yield line + start + ' />'
+        return
+
+    yield line + start + '>'
+
+    # a single row is a straight line, which is not indented
+    if len(rows) > 1:
+        for row in rows:
+            yield row_line + row
+        yield line + end
+
+    else:
+        yield rows[0]
+        yield end
+
+
+def iter_opf_pieces(package, metadata, manifest, spine, toc, indent=None):
+    """
+    Yield the opf string piece by piece.
+
+    :param package: package element, its children are not written
+    :type package: epubaker.xl.Element
+    :param metadata: metadata element
+    :type metadata: epubaker.xl.Element
+    :param manifest: object of :class:`epubaker.epub.Manifest`
+    :param spine: (idref, linear) of every itemref, linear is None if not given
+    :type spine: list
+    :param toc: toc attribute of spine, id of the ncx item
+    :type toc: str
+    :param indent: see :meth:`epubaker.xl.Element.string`
+    :type indent: int
+    """
+    start, full_name, prefixes = start_tag(package)
+    yield start + '>'
+
+    # package has three children, it is never a straight line
+    line = '\n' + ' ' * indent if indent is not None else ''
+    row_line = '\n' + ' ' * (indent * 2) if indent is not None else ''
+
+    # metadata is small, whatever meta objects make is written by the serializer
+    yield line + metadata.string(prefixes, indent, depth=1)
+
+    for piece in _iter_rows('<manifest', '</manifest>', [_item_string(item) for item in manifest.rows],
+                            line, row_line):
+        yield piece
+
+    for piece in _iter_rows('<spine toc="{}"'.format(escape_attribute(toc)), '</spine>',
+                            [_itemref_string(idref, linear) for idref, linear in spine],
+                            line, row_line):
+        yield piece
+
+    yield ('\n' if indent is not None else '') + '</{}>'.format(full_name)
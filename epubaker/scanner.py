@@ -0,0 +1,235 @@
+# coding=utf-8
+
+"""
+Find manifest `properties` of XHTML content documents, in one pass over the data.
+
+Documents are fed to a tokenizer piece by piece, no tree is built, and reading stops as soon as every property is
+found. Tokenizing is pure Python and holds the GIL, many documents are scanned on a pool of processes instead.
+"""
+
+import codecs
+import collections
+import hashlib
+
+from concurrent.futures import ProcessPoolExecutor
+
+from html.parser import HTMLParser
+
+from epubaker.archive import CHUNK_SIZE
+
+
+SCANNER_VERSION = 1
+"""Changes whenever the scanner may give different results for the same document."""
+
+PROPERTIES = ('scripted', 'mathml', 'svg', 'remote-resources', 'switch')
+"""All properties the scanner finds, in the order they are given."""
+
+PARALLEL_MIN_SIZE = 4 * 1024 * 1024
+"""Books with less data to scan than this are scanned in process, starting a pool would cost more than it saves."""
+
+BATCH_SIZE = 16
+"""Number of files sent to a process at a time."""
+
+_SCRIPTED_ELEMENTS = frozenset(['script', 'form'])
+
+# attributes those load resources, <a href> only links to them
+_RESOURCE_ATTRIBUTES = {
+    'audio': ('src',),
+    'embed': ('src',),
+    'iframe': ('src',),
+    'image': ('href', 'xlink:href'),
+    'img': ('src',),
+    'input': ('src',),
+    'link': ('href',),
+    'object': ('data',),
+    'script': ('src',),
+    'source': ('src',),
+    'track': ('src',),
+    'video': ('src', 'poster'),
+}
+
+_REMOTE_PREFIXES = ('http://', 'https://', 'ftp://', '//')
+
+
+class _Done(Exception):
+    pass
+
+
+class _PropertiesParser(HTMLParser):
+    def __init__(self):
+        HTMLParser.__init__(self, convert_charrefs=True)
+        self.found = set()
+
+    def handle_starttag(self, tag, attrs):
+        local_name = tag.rsplit(':', 1)[-1]
+
+        if local_name in _SCRIPTED_ELEMENTS:
+            self.found.add('scripted')
+
+        elif local_name == 'math':
+            self.found.add('mathml')
+
+        elif local_name == 'svg':
+            self.found.add('svg')
+
+        elif local_name == 'switch' and tag != local_name:
+            # epub:switch
+            self.found.add('switch')
+
+        if local_name in _RESOURCE_ATTRIBUTES:
+            names = _RESOURCE_ATTRIBUTES[local_name]
+            for name, value in attrs:
+                if name in names and value and value.strip().lower().startswith(_REMOTE_PREFIXES):
+                    self.found.add('remote-resources')
+                    break
+
+        if len(self.found) == len(PROPERTIES):
+            raise _Done
+
+
+def _decoder_for(head):
+    if head.startswith(codecs.BOM_UTF8):
+        return codecs.getincrementaldecoder('utf-8-sig')(errors='replace')
+
+    if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return codecs.getincrementaldecoder('utf-16')(errors='replace')
+
+    return codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+
+def scan_properties(chunks):
+    """
+    :param chunks: iterable of bytes, a XHTML or HTML document
+    :return: properties found, in the order of :data:`PROPERTIES`
+    :rtype: list
+    """
+    parser = _PropertiesParser()
+    decoder = None
+
+    try:
+        for chunk in chunks:
+            if decoder is None:
+                decoder = _decoder_for(bytes(chunk[:4]))
+
+            parser.feed(decoder.decode(chunk))
+
+        if decoder is not None:
+            parser.feed(decoder.decode(b'', final=True))
+        parser.close()
+
+    except _Done:
+        pass
+
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+    return [one for one in PROPERTIES if one in parser.found]
+
+
+def properties_key(file_):
+    """
+    :param file_: object of :class:`epubaker.File`
+    :return: key of the properties of file_, by its content and :data:`SCANNER_VERSION`
+    :rtype: str
+    """
+    h = hashlib.sha256('epubaker-properties-{}\n'.format(SCANNER_VERSION).encode('ascii'))
+    for chunk in file_.iter_chunks(CHUNK_SIZE):
+        h.update(chunk)
+
+    return h.hexdigest()
+
+
+def scan_file_properties(file_, store=None):
+    """
+    :param file_: object of :class:`epubaker.File`
+    :param store: if given, properties of files scanned before are taken from it, see :mod:`epubaker.stores`
+    :return: properties found, see :func:`scan_properties`
+    :rtype: list
+    """
+    if store is None:
+        return scan_properties(file_.iter_chunks(CHUNK_SIZE))
+
+    key = properties_key(file_)
+
+    value = store.get(key)
+    if value is not None:
+        return value.split()
+
+    properties = scan_properties(file_.iter_chunks(CHUNK_SIZE))
+    store.set(key, ' '.join(properties))
+    return properties
+
+
+def _scan_batch(files):
+    return [scan_file_properties(file_) for file_ in files]
+
+
+def scan_files_properties(files, workers=None, store=None, batch_size=BATCH_SIZE, min_parallel_size=PARALLEL_MIN_SIZE):
+    """
+    :param files: list of :class:`epubaker.File`
+    :param workers: number of processes to scan with, scan in process if None or 1
+    :type workers: int
+    :param store: see :func:`scan_file_properties`
+    :param batch_size: number of files sent to a process at a time
+    :type batch_size: int
+    :param min_parallel_size: scan in process if files to scan are smaller than this in total, a file of unknown size
+     counts as this large
+    :type min_parallel_size: int
+    :return: properties of every file, in the order of files
+    :rtype: list
+    """
+    results = [None] * len(files)
+    keys = [None] * len(files)
+
+    todo = []
+    for i, file_ in enumerate(files):
+        if store is not None:
+            keys[i] = properties_key(file_)
+            value = store.get(keys[i])
+            if value is not None:
+                results[i] = value.split()
+                continue
+
+        todo.append(i)
+
+    size = sum(min_parallel_size if files[i].size is None else files[i].size for i in todo)
+
+    if workers is not None and workers > 1 and len(todo) > batch_size and size >= min_parallel_size:
+        # files are sent as they are, workers read paths and call callables themselves
+        sendable = []
+        local = []
+        for i in todo:
+            (local if files[i]._picklable() is None else sendable).append(i)
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # batches are sent when workers are about to need them, not all at once
+            pending = collections.deque()
+
+            for start in range(0, len(sendable), batch_size):
+                if len(pending) >= workers * 2:
+                    batch, future = pending.popleft()
+                    for i, properties in zip(batch, future.result()):
+                        results[i] = properties
+
+                batch = sendable[start:start + batch_size]
+                pending.append((batch, pool.submit(_scan_batch, [files[i] for i in batch])))
+
+            # while workers scan the last batches
+            for i in local:
+                results[i] = scan_file_properties(files[i])
+
+            while pending:
+                batch, future = pending.popleft()
+                for i, properties in zip(batch, future.result()):
+                    results[i] = properties
+
+    else:
+        for i in todo:
+            results[i] = scan_file_properties(files[i])
+
+    if store is not None:
+        for i in todo:
+            store.set(keys[i], ' '.join(results[i]))
+
+    return results
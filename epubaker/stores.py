@@ -0,0 +1,109 @@
+# coding=utf-8
+
+"""
+Key-value stores for results those are worth keeping between builds, like manifest properties of content documents.
+
+Keys and values are str. Every store has ``get(key)``, returns None if missed, and ``set(key, value)``.
+"""
+
+import collections
+import os
+import sqlite3
+import threading
+import uuid
+
+
+class MemoryStore(object):
+    """Keep the most recently used entries in memory, for builds in one process."""
+    def __init__(self, max_entries=100000):
+        """
+        :param max_entries: the least recently used entries are dropped beyond this
+        :type max_entries: int
+        """
+        self.max_entries = max_entries
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return None
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+
+class SQLiteStore(object):
+    """Keep entries in a SQLite file, it can be shared by builds running at the same time."""
+    def __init__(self, path, timeout=30):
+        """
+        :param path: path of the database file, made if not exist
+        :type path: str
+        :param timeout: seconds to wait for other builds holding the database lock
+        :type timeout: float
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+
+        with self._lock, self._connection:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS store (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+    def get(self, key):
+        with self._lock:
+            row = self._connection.execute('SELECT value FROM store WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value):
+        with self._lock, self._connection:
+            self._connection.execute('INSERT OR REPLACE INTO store (key, value) VALUES (?, ?)', (key, value))
+
+    def close(self):
+        self._connection.close()
+
+
+class DirectoryStore(object):
+    """Keep every entry in a file under a directory, it can be shared by builds running at the same time."""
+    def __init__(self, directory):
+        """
+        :param directory: made if not exist
+        :type directory: str
+        """
+        self.directory = directory
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read().decode('utf-8')
+        except (IOError, OSError):
+            return None
+
+    def set(self, key, value):
+        path = self._path(key)
+
+        dire = os.path.dirname(path)
+        if not os.path.isdir(dire):
+            try:
+                os.makedirs(dire)
+            except OSError:
+                # made by other build just now
+                pass
+
+        tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        with open(tmp_path, 'wb') as f:
+            f.write(value.encode('utf-8'))
+        os.replace(tmp_path, path)
@@ -35,7 +35,7 @@ def identify_mime(binary):
 
     if mime == mime.HTML:
         try:
-            root = parse(binary.decode()).root
+            root = parse(binary).root
             if root.tag == (None, 'html') and root.prefixs[xhtml_uri] is None:
                 return mime.XHTML
         except KeyError:
@@ -1,4 +1,5 @@
 # coding=utf-8
 
-from .xl import Xl, Header, DocType, parse, Element, URI_XML, clean_whitespaces, pretty_insert
+from .xl import Xl, Header, DocType, parse, iterparse, Parser, BACKENDS, set_backend, Element, URI_XML, \
+    clean_whitespaces, pretty_insert, start_tag, escape_attribute, iter_encoded
 from .xl import _Attributes
@@ -4,148 +4,388 @@ from __future__ import print_function
 
 from abc import abstractmethod
 
+import codecs
 import copy
-
-from hooky import List, Dict
+import re
+import weakref
 
 import xml.parsers.expat
 
 
+CHUNK_SIZE = 64 * 1024
+
+
 class HandlerError(Exception):
     pass
 
 
-def parse(xmlstr, debug=False):
+def parse(xmlstr, debug=False, backend=None):
     """
     parse XML string to Xl object
 
-    :param xmlstr:
-    :type xmlstr: str
+    :param xmlstr: bytes are decoded as the XML declaration or byte order mark tells
+    :type xmlstr: str or bytes
     :param debug:
     :type debug: bool
+    :param backend: see :class:`Parser`
+    :type backend: str
     :return: object of :class:`Xl`
     :rtype: Xl
     """
+    parser = Parser(debug=debug, backend=backend)
+    parser.feed(xmlstr)
+    return parser.close()
 
-    xl = Xl()
 
-    out_element = [None]
+def iterparse(source, events=('end',), build=None, chunk_size=CHUNK_SIZE, backend=None):
+    """
+    Parse XML piece by piece, yield events on the way.
+
+    Elements are not put in their parents unless asked by build, so memory use doesn't grow with the document.
+
+    :param source: binary or text file-like object, or iterable of bytes or str pieces
+    :param events: events to yield, of 'start', 'end' and 'text'
+    :type events: tuple
+    :param build: function takes the element of a 'start' event, returns True to build the subtree of it: the element
+     of its 'end' event has all the children. Children of other elements are not kept
+    :param chunk_size: length to read from file-like source every time
+    :type chunk_size: int
+    :param backend: see :class:`Parser`
+    :type backend: str
+    :return: iterator of (event, value), value is :class:`Element` for 'start' and 'end', str for 'text'
+    """
+    for event in events:
+        if event not in ('start', 'end', 'text'):
+            raise ValueError('unknown event: {}'.format(event))
 
-    elements = []
+    if hasattr(source, 'read'):
+        pieces = iter(lambda: source.read(chunk_size), source.read(0))
+    else:
+        pieces = source
 
-    ns_list = []
+    parser = Parser(backend=backend)
+    parser._events = []
+    parser._wanted_events = frozenset(events)
+    parser._build = build or (lambda element: False)
 
-    s = ['']
+    for piece in pieces:
+        parser.feed(piece)
 
-    def start_element(name, attrs):
-        _do_string()
+        for event in parser._events:
+            yield event
+        del parser._events[:]
 
-        print('start_element', name) if debug else None
+    parser.close()
 
-        attributes = {}
+    for event in parser._events:
+        yield event
 
-        l = name.rsplit(' ', 1)
-        tag = l[-1]
 
-        uri = None
-        if len(l) > 1:
-            uri = l[0]
+BACKENDS = ('expat', 'etree', 'lxml')
+"""Parsers those can be used, 'etree' is the C parser of xml.etree.ElementTree, 'lxml' needs lxml installed.
+Trees parsed by any of them are the same, and are written by the same serializer."""
 
-        for key, value in attrs.items():
-            l = key.rsplit(' ', 1)
+_default_backend = ['expat']
 
-            attr_name = l[-1]
 
-            attr_uri = None
-            if len(l) > 1:
-                attr_uri = l[0]
+def set_backend(backend):
+    """
+    :param backend: one of :data:`BACKENDS`, used when no backend is given to parse functions
+    :type backend: str
+    """
+    _etree_module(backend)
+    _default_backend[0] = backend
+
+
+def _etree_module(backend):
+    if backend == 'expat':
+        return None
 
-            attributes[(attr_uri, attr_name)] = value
+    elif backend == 'etree':
+        import xml.etree.ElementTree
+        return xml.etree.ElementTree
 
-        prefixes = {}
+    elif backend == 'lxml':
+        import lxml.etree
+        return lxml.etree
 
-        for _uri, _prefix in ns_list:
+    raise ValueError('unknown backend: {}'.format(backend))
 
-            prefixes[_uri] = _prefix
 
-        e = Element(tag=(uri, tag), attributes=attributes, prefixes=prefixes)
+_DECL_RE = re.compile(r"""<\?xml\s+version\s*=\s*(["'])(?P<version>[^"']*)\1"""
+                      r"""(?:\s+encoding\s*=\s*(["'])(?P<encoding>[^"']*)\3)?"""
+                      r"""(?:\s+standalone\s*=\s*(["'])(?P<standalone>yes|no)\5)?\s*\?>""")
 
-        if elements:
-            elements[-1].children.append(e)
+_DOCTYPE_RE = re.compile(r"""<!DOCTYPE\s+(?P<name>[^\s>\[]+)"""
+                         r"""(?:\s+PUBLIC\s+(["'])(?P<public_id>[^"']*)\2\s+(["'])(?P<system_id>[^"']*)\4"""
+                         r"""|\s+SYSTEM\s+(["'])(?P<system_only_id>[^"']*)\6)?\s*(?P<subset>\[)?""")
 
-        elements.append(e)
 
-        # nonlocal out_element
-        if not out_element[0]:
-            out_element[0] = e
+_ROOT_START_RE = re.compile(r'<[^?!]')
+_ROOT_START_BYTES_RE = re.compile(br'<[^?!]')
 
-    def end_element(name):
-        _do_string()
-        print('end_element', name) if debug else None
-        elements.pop()
 
-    def start_namespace(prefix, uri):
-        print('start_namespace') if debug else None
-        ns_list.append((uri, prefix))
+class Parser(object):
+    """
+    Incremental parser, give it XML piece by piece by :meth:`feed`, then take the :class:`Xl` from :meth:`close`.
+    """
+    def __init__(self, debug=False, backend=None):
+        """
+        :param debug:
+        :type debug: bool
+        :param backend: one of :data:`BACKENDS`, the one set by :func:`set_backend` if None
+        :type backend: str
+        """
+        self._debug = debug
 
-    def end_namespace(prefix):
-        print('end_namespace') if debug else None
-        ns_list.pop()
+        self._xl = Xl()
 
-    def character_data_handler(data):
-        print('Character html: "{}"'.format(data)) if debug else None
-        # nonlocal s
-        s[0] += data
+        # (element, if its children are kept, namespace scope of its children)
+        self._elements = []
 
-    def _do_string():
-        # nonlocal s
-        if s[0] and elements:
-            string = s[0]
-            elements[-1].children.append(string)
-            s[0] = ''
+        # declared by the element to start
+        self._new_prefixes = {}
 
-    def start_doc_type_decl(doc_type_name, system_id, public_id, has_internal_subset):
-        xl.doc_type = DocType(doc_type_name=doc_type_name, system_id=system_id, public_id=public_id)
+        # the parser gives the same str for the same name, turned to tag or attribute name tuple
+        self._names = {}
 
-        if has_internal_subset == 1:
-            raise HandlerError('Has internal subset, cannot handler it!')
+        # pieces of the text, joined once it ends
+        self._text = []
 
-    def decl_handler(version, encoding, standalone):
-        standalone_ = None
+        # for iterparse, events those are not taken yet
+        self._events = None
+        self._wanted_events = frozenset()
+        # for iterparse, if to build subtree of the element, None to build all
+        self._build = None
 
-        if standalone == 1:
-            standalone_ = True
-        elif standalone == 0:
-            standalone_ = False
-        elif standalone == -1:
-            standalone_ = None
+        module = _etree_module(backend or _default_backend[0])
+
+        if module is None:
+            self._expat = self._make_expat()
+            self._pull_parser = None
+        else:
+            self._expat = None
+            options = {}
+            if module.__name__ == 'lxml.etree':
+                # lxml keeps comments and processing instructions as nodes, the text after them is in their tails
+                options = dict(remove_comments=True, remove_pis=True)
+            self._pull_parser = module.XMLPullParser(events=('start-ns', 'start', 'end'), **options)
+            # data before the root, for the XML declaration and doc type the pull parser doesn't tell
+            self._prolog = []
+            # the element whose text or tail is given by the next event
+            self._text_owner = None
+
+    def _make_expat(self):
+        p = xml.parsers.expat.ParserCreate(namespace_separator=' ')
+        p.buffer_text = True
+
+        p.XmlDeclHandler = self._decl_handler
+
+        p.StartDoctypeDeclHandler = self._start_doc_type_decl
+
+        # internal dtd
+        # p.EntityDeclHandler = entity_decl_handler
+
+        p.StartElementHandler = self._start_element
+
+        p.EndElementHandler = self._end_element
+
+        p.StartNamespaceDeclHandler = self._start_namespace
+
+        p.EndNamespaceDeclHandler = self._end_namespace
+
+        p.CharacterDataHandler = self._character_data_handler
+
+        return p
+
+    def feed(self, data):
+        """
+        :param data: next piece of the XML, all pieces must be bytes, or all be str
+        :type data: bytes or str
+        """
+        if self._expat is not None:
+            self._expat.Parse(data, False)
+
+        else:
+            if self._prolog is not None:
+                self._prolog.append(data)
+
+            self._pull_parser.feed(data)
+            self._read_pull_events()
+
+    def close(self):
+        """
+        :return: the XML parsed
+        :rtype: Xl
+        """
+        if self._expat is not None:
+            self._expat.Parse(b'', True)
 
-        xl.header = Header(version=version, encoding=encoding, standalone=standalone_)
+        else:
+            self._pull_parser.close()
+            self._read_pull_events()
+
+        return self._xl
+
+    def _read_pull_events(self):
+        for event, value in self._pull_parser.read_events():
+            if event == 'start-ns':
+                prefix, uri = value
+                self._start_namespace(prefix or None, uri)
+                continue
+
+            if self._prolog is not None:
+                self._read_prolog()
+
+            # text of the last element is complete at the next start or end
+            owner = self._text_owner
+            if owner is not None:
+                text = owner[0].tail if owner[1] else owner[0].text
+                if text:
+                    self._character_data_handler(text)
+
+            if event == 'start':
+                self._start_element(value.tag, value.attrib)
+                self._text_owner = (value, False)
+
+            else:
+                self._end_element(value.tag)
+                self._text_owner = (value, True)
+
+                # children are made into xl elements, and their tails are read
+                del value[:]
+
+    def _read_prolog(self):
+        data = self._prolog[0][:0].join(self._prolog)
+        self._prolog = None
 
-    p = xml.parsers.expat.ParserCreate(namespace_separator=' ', encoding='UTF=8')
+        if isinstance(data, bytes):
+            if data.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+                data = data.decode('utf-16', 'ignore')
+            else:
+                m = _ROOT_START_BYTES_RE.search(data)
+                # only ascii is looked for
+                data = data[:m.start() if m else None].decode('latin-1')
+
+        m = _ROOT_START_RE.search(data)
+        prolog = data[:m.start() if m else None].lstrip('\ufeff\xef\xbb\xbf')
+
+        m = _DECL_RE.match(prolog)
+        if m:
+            standalone = {'yes': 1, 'no': 0}.get(m.group('standalone'), -1)
+            self._decl_handler(m.group('version'), m.group('encoding'), standalone)
+
+        m = _DOCTYPE_RE.search(prolog)
+        if m:
+            system_id = m.group('system_id') if m.group('public_id') is not None else m.group('system_only_id')
+            self._start_doc_type_decl(m.group('name'), system_id, m.group('public_id'), 1 if m.group('subset') else 0)
+
+    def _split_name(self, name):
+        if self._expat is not None:
+            l = name.rsplit(' ', 1)
+            return l[0] if len(l) > 1 else None, l[-1]
+
+        if name[:1] == '{':
+            uri, _, local_name = name[1:].partition('}')
+            return uri, local_name
+
+        return None, name
+
+    def _event(self, event, value):
+        if self._events is not None and event in self._wanted_events:
+            self._events.append((event, value))
+
+    def _name(self, name):
+        try:
+            return self._names[name]
+        except KeyError:
+            self._names[name] = _check_name(self._split_name(name), ValueError)
+            return self._names[name]
+
+    def _start_element(self, name, attrs):
+        self._do_string()
+
+        print('start_element', name) if self._debug else None
+
+        e = Element(tag=self._name(name))
+
+        if attrs:
+            attributes = _Attributes(owner=e)
+            for key, value in attrs.items():
+                dict.__setitem__(attributes, self._name(key), value)
+            e._attributes = attributes
+
+        if self._elements:
+            parent, parent_keeps, scope = self._elements[-1]
+            if parent_keeps:
+                parent.children.append(e)
+        else:
+            parent_keeps = False
+            scope = None
+
+        if self._new_prefixes:
+            scope = _SharedPrefixes.child(scope, self._new_prefixes)
+            self._new_prefixes = {}
 
-    p.XmlDeclHandler = decl_handler
+        # shared by elements until one declares others, copied when changed, see Element.prefixes
+        e._prefixes = scope
 
-    p.StartDoctypeDeclHandler = start_doc_type_decl
+        keep = self._build is None or parent_keeps or self._build(e)
 
-    # internal dtd
-    # p.EntityDeclHandler = entity_decl_handler
+        self._elements.append((e, keep, scope))
 
-    p.StartElementHandler = start_element
+        if self._xl.root is None:
+            self._xl.root = e
 
-    p.EndElementHandler = end_element
+        self._event('start', e)
 
-    p.StartNamespaceDeclHandler = start_namespace
+    def _end_element(self, name):
+        self._do_string()
+        print('end_element', name) if self._debug else None
+        e, _, _ = self._elements.pop()
 
-    p.EndNamespaceDeclHandler = end_namespace
+        self._event('end', e)
 
-    p.CharacterDataHandler = character_data_handler
+    def _start_namespace(self, prefix, uri):
+        print('start_namespace') if self._debug else None
+        self._new_prefixes[uri] = prefix
 
-    p.Parse(xmlstr, 1)
+    def _end_namespace(self, prefix):
+        print('end_namespace') if self._debug else None
 
-    xl.root = out_element[0]
+    def _character_data_handler(self, data):
+        print('Character html: "{}"'.format(data)) if self._debug else None
+        self._text.append(data)
 
-    return xl
+    def _do_string(self):
+        if self._text:
+            string = ''.join(self._text) if len(self._text) > 1 else self._text[0]
+            self._text = []
+
+            if self._elements:
+                e, keep, _ = self._elements[-1]
+                if keep:
+                    e.children.append(string)
+
+                self._event('text', string)
+
+    def _start_doc_type_decl(self, doc_type_name, system_id, public_id, has_internal_subset):
+        self._xl.doc_type = DocType(doc_type_name=doc_type_name, system_id=system_id, public_id=public_id)
+
+        if has_internal_subset == 1:
+            raise HandlerError('Has internal subset, cannot handler it!')
+
+    def _decl_handler(self, version, encoding, standalone):
+        standalone_ = None
+
+        if standalone == 1:
+            standalone_ = True
+        elif standalone == 0:
+            standalone_ = False
+        elif standalone == -1:
+            standalone_ = None
+
+        self._xl.header = Header(version=version, encoding=encoding, standalone=standalone_)
 
 
 class ObjectAttributeError(Exception):
@@ -176,9 +416,9 @@ def clean_whitespaces(element):
     if not isinstance(element, Element):
         raise TypeError
 
-    new_element = Element(tag=copy.deepcopy(element.tag),
-                          attributes=copy.deepcopy(element.attributes),
-                          prefixes=copy.deepcopy(element.prefixes))
+    new_element = Element(tag=element.tag,
+                          attributes=copy.deepcopy(element._attributes),
+                          prefixes=copy.deepcopy(element._prefixes))
 
     for child in element.children:
         if isinstance(child, str):
@@ -222,9 +462,9 @@ def pretty_insert(element, start_indent=0, step=4, dont_do_when_one_child=True):
     :return: object of :class:`Element`
     """
 
-    new_element = Element(tag=copy.deepcopy(element.tag),
-                          attributes=copy.deepcopy(element.attributes),
-                          prefixes=copy.deepcopy(element.prefixes))
+    new_element = Element(tag=element.tag,
+                          attributes=copy.deepcopy(element._attributes),
+                          prefixes=copy.deepcopy(element._prefixes))
 
     _indent_text = '\n' + ' ' * (start_indent + step)
 
@@ -280,22 +520,85 @@ class Xl(object):
         self.root = root
         """object of :class:`Element`"""
 
-    def string(self):
-        """To xml string"""
-        s = ''
+    def string(self, **options):
+        """To xml string
+
+        :param options: see :meth:`Element.string`
+        """
+        return ''.join(self._iter_pieces(**options))
+
+    def iter_chunks(self, chunk_size=CHUNK_SIZE, **options):
+        """Yield the xml string piece by piece, see :meth:`Element.iter_chunks`"""
+        return _join_pieces(self._iter_pieces(**options), chunk_size)
+
+    def write(self, stream, chunk_size=CHUNK_SIZE, **options):
+        """
+        :param stream: text file-like object to write the xml string to
+        :param chunk_size: see :meth:`Element.iter_chunks`
+        :type chunk_size: int
+        :param options: see :meth:`Element.string`
+        """
+        for chunk in self.iter_chunks(chunk_size, **options):
+            stream.write(chunk)
+
+    def to_bytes(self, encoding=None, **options):
+        """
+        To xml bytes, encoded while serializing, no xml string of the whole is made.
+
+        :param encoding: encoding of :attr:`header` or utf-8 if None. Characters can't be encoded in it become
+         numeric character references
+        :type encoding: str
+        :param options: see :meth:`Element.string`
+        :rtype: bytes
+        """
+        return b''.join(self.iter_bytes(encoding=encoding, **options))
 
+    def iter_bytes(self, chunk_size=CHUNK_SIZE, encoding=None, **options):
+        """Yield the xml bytes piece by piece, see :meth:`to_bytes` and :meth:`Element.iter_chunks`"""
+        encoding = self._encoding(encoding)
+        return iter_encoded(self._iter_pieces(encoding, **options), encoding, chunk_size)
+
+    def write_bytes(self, stream, chunk_size=CHUNK_SIZE, encoding=None, **options):
+        """
+        :param stream: binary file-like object to write the xml bytes to, like a zip entry
+        :param chunk_size: see :meth:`Element.iter_chunks`
+        :type chunk_size: int
+        :param encoding: see :meth:`to_bytes`
+        :type encoding: str
+        :param options: see :meth:`Element.string`
+        """
+        for data in self.iter_bytes(chunk_size, encoding, **options):
+            stream.write(data)
+
+    def _encoding(self, encoding):
+        if encoding is None:
+            encoding = self.header.encoding if self.header else 'utf-8'
+
+        # raises LookupError for unknown encoding
+        codecs.lookup(encoding)
+
+        return encoding
+
+    def _iter_pieces(self, encoding=None, **options):
         if self.header:
-            s += self.header.string() + '\n'
+            header = self.header
 
-        if self.doc_type:
-            s += self.doc_type.string() + '\n'
+            # declare the encoding it is written in
+            if encoding is not None and codecs.lookup(encoding).name != codecs.lookup(header.encoding).name:
+                header = Header(version=header.version, encoding=encoding, standalone=header.standalone)
 
-        s += self.root.string()
+            yield header.string() + '\n'
 
-        return s
+        if self.doc_type:
+            yield self.doc_type.string() + '\n'
+
+        for piece in _iter_pieces(self.root, **options):
+            yield piece
 
 
 class _Node(object):
+    __slots__ = ()
+
     @abstractmethod
     def string(self):
         pass
@@ -367,8 +670,9 @@ class Element(_Node):
     """
     Handle XML element node.
     """
+    __slots__ = ('_tag', '_attributes', '_prefixes', '_children', '_index', '_indexes')
+
     def __init__(self, tag=None, attributes=None, prefixes=None):
-        _Node.__init__(self)
         """
         :param tag:
         :type tag: tuple or str
@@ -377,38 +681,31 @@ class Element(_Node):
         :param prefixes:
         :type prefixes: _Prefixes or dict
         """
+        self._tag = _check_name(tag if isinstance(tag, tuple) else (None, tag), ValueError)
 
-        self._tag = None
+        # indexes this element is in, see _Index
+        self._indexes = None
 
-        self.tag = tag
-        """tuple object of length 2.
+        # made when first used, most elements have no attributes or prefixes of their own
+        self._attributes = _Attributes(attributes, self) if attributes else None
+        self._prefixes = _Prefixes(prefixes) if prefixes else None
 
-        First in the tuple is the url of the namespaces,
-        the second is the xml element tag you know ordinarily.
-        """
+        self._children = _Children(owner=self)
 
-        self._attributes = _Attributes(attributes) if attributes else _Attributes()
-        """dict-like.
+        self._index = None
 
-        Store xml attribute names and values in *keys* and *values*
-
-        """
-
-        self._prefixes = _Prefixes(prefixes) if prefixes else _Prefixes()
-        """dict-like.
-
-        Store xml namespaces urls and prefixes in *keys* and *values*
-
-        Ignore this is fine, because you will get automatic prefixes for the namespaces.
-        """
-
-        self._children = _Children()
-        """list-like.
-
-        Store children Node"""
+    def __reduce__(self):
+        # indexes and owners of the containers are not copied
+        return _make_element, (self._tag, self._attributes and dict(self._attributes), self._prefixes,
+                               list(self._children))
 
     @property
     def tag(self):
+        """tuple object of length 2.
+
+        First in the tuple is the url of the namespaces,
+        the second is the xml element tag you know ordinarily.
+        """
         return self._tag
 
     @tag.setter
@@ -416,259 +713,800 @@ class Element(_Node):
         if not isinstance(value, tuple):
             value = (None, value)
 
-        if len(value) != 2:
-            raise ValueError
-
-        if value[0] is not None:
-            if isinstance(value[0], str):
-                pass
-            elif isinstance(value[0], unicode):
-                pass
-            else:
-                raise ValueError
-
-        if isinstance(value[1], str):
-            pass
-        elif isinstance(value[1], unicode):
-            pass
-        else:
-            raise ValueError
-
-        self._tag = value
+        self._tag = _check_name(value, ValueError)
+        _changed(self)
 
     @property
     def prefixes(self):
+        """dict-like.
+
+        Store xml namespaces urls and prefixes in *keys* and *values*
+
+        Ignore this is fine, because you will get automatic prefixes for the namespaces.
+        """
+        if self._prefixes is None or type(self._prefixes) is _SharedPrefixes:
+            self._prefixes = _Prefixes(self._prefixes)
         return self._prefixes
 
     @prefixes.setter
     def prefixes(self, value):
-        self._prefixes = value
+        self._prefixes = value if isinstance(value, _Prefixes) else _Prefixes(value)
 
     @property
     def attributes(self):
+        """dict-like.
+
+        Store xml attribute names and values in *keys* and *values*
+        """
+        if self._attributes is None:
+            self._attributes = _Attributes(owner=self)
         return self._attributes
 
     @attributes.setter
     def attributes(self, value):
-        self._attributes = value
+        self._attributes = _Attributes(value, self)
+        _changed(self)
 
     @property
     def children(self):
+        """list-like.
+
+        Store children Node"""
         return self._children
 
     @children.setter
     def children(self, value):
-        self._children = value
-        self.__dict__['children'] = value
+        self._children = _Children(value, self)
+        _changed(self)
+
+    def iter(self):
+        """Yield this element and all elements under it, in document order."""
+        stack = [iter((self,))]
+        while stack:
+            for child in stack[-1]:
+                if isinstance(child, Element):
+                    yield child
+                    if child._children:
+                        stack.append(iter(child._children))
+                        break
+            else:
+                stack.pop()
 
-    def string(self, inherited_prefixes=None):
-        """to string, you may want to see :class:`Xl.string`"""
-        if self.tag[1] is None:
-            raise TypeError
+    def find_all(self, tag=None, attributes=None, predicate=None):
+        """
+        Find in this element and all elements under it.
 
-        inherited_prefixes = inherited_prefixes or _Prefixes()
+        Elements are indexed by tag and attribute values when first asked, later finds take them from the index,
+        until an element in it is changed.
 
-        auto_prefixs = _Prefixes()
+        :param tag: (url, name) or name
+        :type tag: tuple or str
+        :param attributes: attribute names and values elements must have
+        :type attributes: dict
+        :param predicate: function takes an element, returns True if it is wanted
+        :return: elements found, in document order
+        :rtype: list
+        """
+        index = self._get_index()
 
-        def make_a_auto_prefix(_uri):
-            _prefix_num = 0
-            while 'prefix' + str(_prefix_num) in \
-                    [one for one in self.prefixes.values()] + \
-                    [one for one in inherited_prefixes.values()] + \
-                    [one for one in auto_prefixs.values()]:
+        if tag is not None and not isinstance(tag, tuple):
+            tag = (None, tag)
 
-                _prefix_num += 1
+        checks = []
+        if attributes:
+            attributes = [(name if isinstance(name, tuple) else (None, name), value)
+                          for name, value in attributes.items()]
 
-            _prefix = 'prefix' + str(_prefix_num)
-            auto_prefixs[_uri] = _prefix
+            name, value = attributes[0]
+            candidates = index.attribute_values(name).get(value, [])
+            checks.extend(attributes[1:])
 
-            return _prefix
+            if tag is not None:
+                candidates = [e for e in candidates if e._tag == tag]
 
-        def get_prefix(_uri):
+        elif tag is not None:
+            candidates = index.tags.get(tag, [])
 
-            if _uri in self.prefixes.keys():
-                _prefix = self.prefixes[_uri]
+        else:
+            candidates = index.elements
 
-            elif _uri in inherited_prefixes.keys():
-                _prefix = inherited_prefixes[_uri]
+        if checks:
+            candidates = [e for e in candidates if all(e._attributes.get(name) == value for name, value in checks)]
 
-            elif _uri in auto_prefixs.keys():
-                _prefix = auto_prefixs[_uri]
+        if predicate is not None:
+            candidates = [e for e in candidates if predicate(e)]
 
-            else:
-                raise ValueError
+        return list(candidates)
 
-            return _prefix
+    def find(self, tag=None, attributes=None, predicate=None):
+        """
+        :return: the first element :meth:`find_all` finds, None if not found
+        :rtype: Element
+        """
+        found = self.find_all(tag, attributes, predicate)
+        return found[0] if found else None
 
-        s = '<'
+    def find_by_id(self, id_):
+        """
+        :param id_: value of attribute id or xml:id
+        :type id_: str
+        :return: the element, None if not found
+        :rtype: Element
+        """
+        return self.find(attributes={(None, 'id'): id_}) or self.find(attributes={(URI_XML, 'id'): id_})
+
+    def _get_index(self):
+        if self._index is None or not self._index.valid:
+            self._index = _Index(list(self.iter()))
+        return self._index
+
+    def string(self, inherited_prefixes=None, indent=None, compact_single_child=True, strip_whitespaces=False,
+               depth=0):
+        """to string, you may want to see :class:`Xl.string`
+
+        :param indent: if given, put every child on a new line, indented by this many spaces more than its parent,
+         the same as :func:`pretty_insert` does but no copy of the element is made
+        :type indent: int
+        :param compact_single_child: don't indent elements those have no more than one child, and so on for the child,
+         like dont_do_when_one_child of :func:`pretty_insert`
+        :type compact_single_child: bool
+        :param strip_whitespaces: strip whitespaces around texts and leave out blank ones, as :func:`clean_whitespaces`
+         does. With indent None, nothing is put between elements
+        :type strip_whitespaces: bool
+        :param depth: where this element is in a document written piece by piece, its children and end tag are
+         indented as deep, but not its start tag
+        :type depth: int
+        """
+        return ''.join(_iter_pieces(self, inherited_prefixes, indent, compact_single_child, strip_whitespaces, depth))
 
-        ################################################################################################################
-        # processing xml tag
-        if self.tag[0] is not None:
-            try:
-                prefix = get_prefix(self.tag[0])
-            except ValueError:
-                prefix = make_a_auto_prefix(self.tag[0])
+    def iter_chunks(self, chunk_size=CHUNK_SIZE, inherited_prefixes=None, **options):
+        """Yield the xml string piece by piece, no string of the whole is made.
 
-            if prefix is not None:
-                full_name = '{}:{}'.format(prefix, self.tag[1])
-            else:
-                full_name = self.tag[1]
-        else:
-            full_name = self.tag[1]
+        :param chunk_size: least length of every piece but the last
+        :type chunk_size: int
+        :param options: see :meth:`string`
+        """
+        return _join_pieces(_iter_pieces(self, inherited_prefixes, **options), chunk_size)
 
-        s += full_name
+    def write(self, stream, chunk_size=CHUNK_SIZE, inherited_prefixes=None, **options):
+        """
+        :param stream: text file-like object to write the xml string to
+        :param chunk_size: see :meth:`iter_chunks`
+        :type chunk_size: int
+        :param options: see :meth:`string`
+        """
+        for chunk in self.iter_chunks(chunk_size, inherited_prefixes, **options):
+            stream.write(chunk)
 
-        ################################################################################################################
-        # processing xml attributes
-        _attrs_string_list = []
-        for attr_name, attr_value in self.attributes.items():
 
-            if attr_name[0] is not None:
-                try:
-                    prefix = get_prefix(attr_name[0])
-                except ValueError:
-                    prefix = make_a_auto_prefix(attr_name[0])
-                _attrs_string_list.append('{}:{}="{}"'.format(prefix, attr_name[1], attr_value))
+class _Scope(object):
+    """Namespace prefixes in effect for an element. Never changed after made, an element shares the scope of its
+    parent unless it declares prefixes or needs automatic ones."""
+    __slots__ = ('prefixes', 'used')
 
-            else:
-                _attrs_string_list.append('{}="{}"'.format(attr_name[1], attr_value))
+    def __init__(self, prefixes, used=None):
+        """
+        :param prefixes: urls and prefixes
+        :type prefixes: dict
+        :param used: prefixes can't be taken by automatic ones, values of prefixes if None
+        :type used: frozenset
+        """
+        self.prefixes = prefixes
+        self.used = frozenset(prefixes.values()) if used is None else used
+
+    def child(self, prefixes):
+        """
+        :param prefixes: urls and prefixes declared by an element
+        :type prefixes: dict
+        :return: scope for the element
+        :rtype: _Scope
+        """
+        merged = dict(self.prefixes)
+        merged.update(prefixes)
+        return _Scope(merged, self.used.union(prefixes.values()))
 
-        if _attrs_string_list:
-            s += ' '
-            s += ' '.join(_attrs_string_list)
 
-        ################################################################################################################
-        # processing xml prefixes
-        _prefix_string_list = []
-        for url, prefix in self.prefixes.items():
-            if url == URI_XML:
+_XML_SCOPE = _Scope({URI_XML: 'xml'})
+
+
+def _make_scope(inherited_prefixes):
+    if inherited_prefixes is None:
+        return _XML_SCOPE
+
+    return _Scope(dict(inherited_prefixes.items()))
+
+
+def _start_tag(element, scope):
+    """
+    :param scope: scope of the parent
+    :type scope: _Scope
+    :return: (start tag without the closing bracket, full tag name, scope for children)
+    """
+    if element.tag[1] is None:
+        raise TypeError
+
+    inherited = scope.prefixes
+
+    declared = None
+    if element._prefixes:
+        for url, prefix in element._prefixes.items():
+            if url in inherited and inherited[url] == prefix:
                 continue
 
-            if url in inherited_prefixes.keys() and prefix == inherited_prefixes[url]:
+            if declared is None:
+                declared = {}
+            declared[url] = prefix
+
+    if declared:
+        scope = scope.child(declared)
+
+    prefixes = scope.prefixes
+    auto_prefixes = {}
+
+    def get_prefix(_uri):
+        if _uri in prefixes:
+            return prefixes[_uri]
+
+        if _uri in auto_prefixes:
+            return auto_prefixes[_uri]
+
+        _prefix_num = 0
+        while 'prefix' + str(_prefix_num) in scope.used or 'prefix' + str(_prefix_num) in auto_prefixes.values():
+            _prefix_num += 1
+
+        _prefix = 'prefix' + str(_prefix_num)
+        auto_prefixes[_uri] = _prefix
+
+        return _prefix
+
+    ################################################################################################################
+    # processing xml tag
+    full_name = element.tag[1]
+    if element.tag[0] is not None:
+        prefix = get_prefix(element.tag[0])
+        if prefix is not None:
+            full_name = '{}:{}'.format(prefix, element.tag[1])
+
+    pieces = ['<', full_name]
+
+    ################################################################################################################
+    # processing xml attributes
+    if element._attributes:
+        for attr_name, attr_value in element._attributes.items():
+            if attr_name[0] is not None:
+                pieces.append(' {}:{}="{}"'.format(get_prefix(attr_name[0]), attr_name[1],
+                                                    escape_attribute(attr_value)))
+            else:
+                pieces.append(' {}="{}"'.format(attr_name[1], escape_attribute(attr_value)))
+
+    ################################################################################################################
+    # processing xml prefixes
+    for prefixes_ in (declared, auto_prefixes):
+        if not prefixes_:
+            continue
+
+        for url, prefix in prefixes_.items():
+            if url == URI_XML or not url:
                 continue
 
-            if url:
-                if prefix:
-                    _prefix_string_list.append('xmlns:{}="{}"'.format(prefix, url))
-                else:
-                    _prefix_string_list.append('xmlns="{}"'.format(url))
+            if prefix:
+                pieces.append(' xmlns:{}="{}"'.format(prefix, escape_attribute(url)))
+            else:
+                pieces.append(' xmlns="{}"'.format(escape_attribute(url)))
 
-        if _prefix_string_list:
-            s += ' '
-            s += ' '.join(_prefix_string_list)
+    if auto_prefixes:
+        scope = scope.child(auto_prefixes)
 
-        ################################################################################################################
-        # processing children
-        if self.children:
-            s += '>'
+    return ''.join(pieces), full_name, scope
 
-            prefixes_for_subs = inherited_prefixes.copy()
-            prefixes_for_subs.update(self.prefixes)
-            prefixes_for_subs.update(auto_prefixs)
 
-            for child in self.children:
-                if isinstance(child, Element):
-                    s += child.string(inherited_prefixes=prefixes_for_subs)
+def start_tag(element, inherited_prefixes=None):
+    """
+    For writing a document piece by piece, with elements of the known shape written directly.
+
+    :param element: its children are not written
+    :type element: Element
+    :param inherited_prefixes: urls and prefixes in effect for the parent
+    :type inherited_prefixes: dict
+    :return: (start tag without the closing bracket, full tag name for the end tag, urls and prefixes in effect for
+     the children)
+    :rtype: tuple
+    """
+    start, full_name, scope = _start_tag(element, _make_scope(inherited_prefixes))
+    return start, full_name, scope.prefixes
+
+
+def iter_encoded(pieces, encoding='utf-8', chunk_size=CHUNK_SIZE):
+    """
+    Encode xml string pieces as they come, no string of the whole is made. Characters can't be encoded in encoding
+    become numeric character references.
+
+    :param pieces: iterable of str
+    :param encoding: as declared in the header, if any
+    :type encoding: str
+    :param chunk_size: see :meth:`Element.iter_chunks`
+    :type chunk_size: int
+    :return: iterator of bytes
+    """
+    encoder = codecs.getincrementalencoder(encoding)(errors='xmlcharrefreplace')
+
+    for chunk in _join_pieces(pieces, chunk_size):
+        data = encoder.encode(chunk)
+        if data:
+            yield data
+
+    data = encoder.encode('', final=True)
+    if data:
+        yield data
+
+
+def _count_children(element, strip_whitespaces):
+    """
+    :return: (number of children but no more than 2, the first child)
+    """
+    children = element._children
+
+    if not strip_whitespaces:
+        return min(len(children), 2), children[0] if children else None
+
+    count = 0
+    first = None
+    for child in children:
+        if isinstance(child, Element) or (isinstance(child, str) and child.strip()):
+            if count:
+                return 2, first
 
-                # elif isinstance(child, Text):
-                #    s += child.string()
+            count = 1
+            first = child
 
-                elif isinstance(child, str):
-                    s += _escape(child)
+    return count, first
 
-            s += '</{}>'.format(full_name)
+
+def _iter_children(element, strip_whitespaces):
+    if not strip_whitespaces:
+        return iter(element.children)
+
+    return _iter_stripped_children(element)
+
+
+def _iter_stripped_children(element):
+    for child in element.children:
+        if isinstance(child, Element):
+            yield child
+
+        elif isinstance(child, str):
+            child = child.strip()
+            if child:
+                yield child
+
+
+def _is_straight_chain(element, strip_whitespaces):
+    """The same as :func:`_is_straight_line`, without recursion."""
+    while True:
+        count, first = _count_children(element, strip_whitespaces)
+
+        if count != 1:
+            return count == 0
+
+        if not isinstance(first, Element):
+            return True
+
+        element = first
+
+
+def _iter_pieces(element, inherited_prefixes=None, indent=None, compact_single_child=True, strip_whitespaces=False,
+                 depth=0):
+    """Serialize element with an explicit stack instead of recursion, so deep trees neither copy the strings of
+    their subtrees at every level nor hit the recursion limit.
+
+    depth is where element is in the document, its children and end tag are indented by it, but not its start tag.
+    """
+    def is_pretty(_element):
+        if indent is None:
+            return False
+
+        return not (compact_single_child and _is_straight_chain(_element, strip_whitespaces))
+
+    start, full_name, scope = _start_tag(element, _make_scope(inherited_prefixes))
+    count, _ = _count_children(element, strip_whitespaces)
+
+    if not count:
+        yield start + ' />'
+        return
+
+    yield start + '>'
+
+    # children, full name, scope, if to indent children, number of children, depth
+    stack = [(_iter_children(element, strip_whitespaces), full_name, scope, is_pretty(element), count, depth)]
+    while stack:
+        children, full_name, scope, pretty, count, depth = stack[-1]
+
+        indent_text = '\n' + ' ' * (indent * (depth + 1)) if pretty else ''
+
+        for child in children:
+            if isinstance(child, Element):
+                start, child_full_name, child_scope = _start_tag(child, scope)
+                child_count, _ = _count_children(child, strip_whitespaces)
+
+                if not child_count:
+                    yield indent_text + start + ' />'
+                    continue
+
+                yield indent_text + start + '>'
+
+                if not pretty:
+                    # all in a straight line are not indented
+                    child_pretty = False
+                elif count == 1:
+                    # in the same chain as the parent, which is not a straight line
+                    child_pretty = True
+                else:
+                    child_pretty = is_pretty(child)
+
+                stack.append((_iter_children(child, strip_whitespaces), child_full_name, child_scope,
+                              child_pretty, child_count, depth + 1))
+                break
+
+            elif isinstance(child, str):
+                yield indent_text + _escape(child)
 
         else:
-            s += ' />'
+            stack.pop()
 
-        return s
+            if pretty:
+                yield '\n' + ' ' * (indent * depth) + '</{}>'.format(full_name)
+            else:
+                yield '</{}>'.format(full_name)
 
 
-class _Prefixes(Dict):
-    def _before_add(self, key=None, item=None):
-        if key == URI_XML and item != 'xml':
-            raise ValueError
+def _join_pieces(pieces, chunk_size):
+    buffer = []
+    size = 0
+    for piece in pieces:
+        buffer.append(piece)
+        size += len(piece)
 
-        if item in self.values() and (key not in self.keys() or item != self[key]):
-            raise ValueError
+        if size >= chunk_size:
+            yield ''.join(buffer)
+            buffer = []
+            size = 0
+
+    if buffer:
+        yield ''.join(buffer)
+
+
+def _make_element(tag, attributes, prefixes, children):
+    e = Element(tag, attributes)
+    e._prefixes = prefixes
+    e._children.extend(children)
+    return e
+
+
+def _changed(element):
+    """Make indexes those have element out of date, called whenever its tag, attributes or children are changed."""
+    if element is not None and element._indexes:
+        for ref in element._indexes:
+            index = ref()
+            if index is not None:
+                index.valid = False
+
+        element._indexes = None
+
+
+class _Index(object):
+    """Elements of a tree by tag and by attribute values. Every element keeps weak references to the indexes it is in,
+    a change to it makes only these out of date, not indexes of other trees."""
+    __slots__ = ('valid', 'elements', 'tags', '_attribute_values', '__weakref__')
+
+    def __init__(self, elements):
+        self.valid = True
+        self.elements = elements
+
+        ref = weakref.ref(self)
+
+        self.tags = {}
+        for e in elements:
+            self.tags.setdefault(e._tag, []).append(e)
+
+            if e._indexes:
+                e._indexes = [one for one in e._indexes if one() is not None and one().valid]
+                e._indexes.append(ref)
+            else:
+                e._indexes = [ref]
+
+        self._attribute_values = {}
+
+    def attribute_values(self, name):
+        """
+        :return: values of the attribute to elements have it, made when first asked
+        :rtype: dict
+        """
+        try:
+            return self._attribute_values[name]
+        except KeyError:
+            pass
+
+        values = {}
+        for e in self.elements:
+            if e._attributes and name in e._attributes:
+                value = e._attributes[name]
+                try:
+                    values.setdefault(value, []).append(e)
+                except TypeError:
+                    # not hashable
+                    pass
+
+        self._attribute_values[name] = values
+        return values
+
+
+# checked names, it is only for sharing, when it is full it is started again, names already in elements are still good
+_names = {}
+_MAX_NAMES = 4096
+
+
+def _check_name(name, error):
+    """
+    :param name: (url, name)
+    :type name: tuple
+    :param error: exception class to raise if name is not legal
+    :return: the same tuple for names are equal, elements of one document share a few of them
+    :rtype: tuple
+    """
+    try:
+        return _names[name]
+    except KeyError:
+        pass
+    except TypeError:
+        # not hashable
+        raise error
+
+    if len(name) != 2 or not (name[0] is None or isinstance(name[0], str)) or not isinstance(name[1], str):
+        raise error
+
+    if len(_names) >= _MAX_NAMES:
+        _names.clear()
+
+    return _names.setdefault(name, name)
+
+
+# The containers below are builtin dict and list, reading them costs nothing more, only the methods those put items
+# in check them.
+
+class _Prefixes(dict):
+    __slots__ = ()
 
     def __init__(self, prefixes=None):
-        Dict.__init__(self)
+        dict.__init__(self)
 
-        self[URI_XML] = 'xml'
+        dict.__setitem__(self, URI_XML, 'xml')
 
         if prefixes:
             self.update(prefixes)
 
+    def __setitem__(self, key, item):
+        if key == URI_XML and item != 'xml':
+            raise ValueError
+
+        if item in self.values() and (key not in self or item != self[key]):
+            raise ValueError
+
+        dict.__setitem__(self, key, item)
+
+    def update(self, *args, **kwargs):
+        for key, item in dict(*args, **kwargs).items():
+            self[key] = item
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+
+class _SharedPrefixes(_Prefixes):
+    """Prefixes in effect, shared by parsed elements, never changed."""
+    __slots__ = ()
+
+    @classmethod
+    def child(cls, parent, prefixes):
+        """
+        :param parent: prefixes in effect for the parent, None for the root
+        :type parent: _SharedPrefixes
+        :param prefixes: urls and prefixes declared by the element
+        :type prefixes: dict
+        :return: prefixes in effect for the element
+        :rtype: _SharedPrefixes
+        """
+        new = cls()
+
+        if parent:
+            # a prefix declared again is bound to the new url only
+            rebound = set(prefixes.values())
+            for url, prefix in parent.items():
+                if prefix not in rebound or url in prefixes:
+                    dict.__setitem__(new, url, prefix)
+
+        for url, prefix in prefixes.items():
+            dict.__setitem__(new, url, prefix)
+
+        return new
+
+
+class _Attributes(dict):
+    __slots__ = ('_owner',)
+
+    def __init__(self, attributes=None, owner=None):
+        """
+        :param owner: element the attributes belong to, its indexes are made out of date by changes
+        :type owner: Element
+        """
+        dict.__init__(self)
 
-class _Attributes(Dict):
-    def __init__(self, attributes=None):
-        Dict.__init__(self)
+        self._owner = owner
 
         if attributes:
             self.update(attributes)
 
+    def __reduce__(self):
+        return self.__class__, (dict(self),)
+
     def __setitem__(self, key, value):
         if not isinstance(key, tuple):
             key = (None, key)
 
-        if key[0] is not None:
-            if isinstance(key[0], str):
-                pass
+        key = _check_name(key, KeyError)
 
-            elif isinstance(key[0], unicode):
-                pass
+        if key == (None, 'xmlns'):
+            raise AttributeError
 
-            else:
-                raise KeyError
+        dict.__setitem__(self, key, value)
+        _changed(self._owner)
 
-        if isinstance(key[1], str):
-            pass
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        _changed(self._owner)
 
-        elif isinstance(key[1], unicode):
-            pass
+    def pop(self, *args):
+        _changed(self._owner)
+        return dict.pop(self, *args)
 
-        else:
-            raise KeyError
+    def popitem(self):
+        _changed(self._owner)
+        return dict.popitem(self)
 
-        if key == (None, 'xmlns'):
-            raise AttributeError
+    def clear(self):
+        dict.clear(self)
+        _changed(self._owner)
 
-        Dict.__setitem__(self, key, value)
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
 
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
 
-class _Children(List):
-    def __init__(self):
-        List.__init__(self)
 
-    def _before_add(self, key=None, item=None):
-        if isinstance(item, (_Node, str)):
-            pass
+class _Children(list):
+    __slots__ = ('_owner',)
 
-        elif isinstance(item, unicode):
-            pass
+    def __init__(self, children=None, owner=None):
+        """
+        :param owner: element the children belong to, its indexes are made out of date by changes
+        :type owner: Element
+        """
+        list.__init__(self)
 
-        else:
+        self._owner = owner
+
+        if children:
+            self.extend(children)
+
+    def __reduce__(self):
+        return self.__class__, (list(self),)
+
+    @staticmethod
+    def _check(item):
+        if not isinstance(item, (_Node, str)):
             raise TypeError('{} is not legal'.format(item.__class__.__name__))
 
+    def append(self, item):
+        self._check(item)
+        list.append(self, item)
+        _changed(self._owner)
+
+    def insert(self, i, item):
+        self._check(item)
+        list.insert(self, i, item)
+        _changed(self._owner)
+
+    def extend(self, items):
+        items = list(items)
+        for item in items:
+            self._check(item)
+        list.extend(self, items)
+        _changed(self._owner)
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def __setitem__(self, i, item):
+        if isinstance(i, slice):
+            item = list(item)
+            for one in item:
+                self._check(one)
+        else:
+            self._check(item)
+
+        list.__setitem__(self, i, item)
+        _changed(self._owner)
+
+    def __delitem__(self, i):
+        list.__delitem__(self, i)
+        _changed(self._owner)
+
+    def __imul__(self, n):
+        _changed(self._owner)
+        return list.__imul__(self, n)
+
+    def pop(self, *args):
+        _changed(self._owner)
+        return list.pop(self, *args)
+
+    def remove(self, item):
+        list.remove(self, item)
+        _changed(self._owner)
+
+    def clear(self):
+        list.clear(self)
+        _changed(self._owner)
+
+    def reverse(self):
+        list.reverse(self)
+        _changed(self._owner)
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        _changed(self._owner)
+
+
+_TEXT_ESCAPES = {ord('&'): '&amp;', ord('<'): '&lt;', ord('>'): '&gt;'}
+
+_ATTRIBUTE_ESCAPES = dict(_TEXT_ESCAPES)
+_ATTRIBUTE_ESCAPES[ord('"')] = '&quot;'
+
 
 def _escape(string):
     """
+    Escape text, strings need no escaping are returned as they are.
 
     :param string:
      :type string: str
     :return:
      :rtype: str
     """
-    s = ''
-    for char in string:
-        if char == '&':
-            s += '&amp;'
-        elif char == '<':
-            s += '&lt;'
-        elif char == '>':
-            s += '&gt;'
-        else:
-            s += str(char)
-    return s
+    # "in" is a fast search, most texts have none of them
+    if '&' in string or '<' in string or '>' in string:
+        return string.translate(_TEXT_ESCAPES)
+
+    return string
+
+
+def escape_attribute(value):
+    """
+    Escape attribute value to be put in double quotes.
+
+    :param value:
+     :type value: str
+    :return:
+     :rtype: str
+    """
+    if not isinstance(value, str):
+        value = str(value)
+
+    if '&' in value or '<' in value or '>' in value or '"' in value:
+        return value.translate(_ATTRIBUTE_ESCAPES)
+
+    return value
@@ -18,10 +18,8 @@ CLASSIFIERS = [
     'Intended Audience :: Developers',
     'License :: OSI Approved :: MIT License',
     'Operating System :: OS Independent',
-    'Programming Language :: Python :: 2',
-    'Programming Language :: Python :: 2.7',
     'Programming Language :: Python :: 3',
-    'Programming Language :: Python :: 3.3',
+    'Programming Language :: Python :: 3 :: Only',
     'Programming Language :: Python :: 3.4',
     'Programming Language :: Python :: 3.5',
     'Programming Language :: Python :: Implementation :: CPython',
@@ -45,4 +43,5 @@ setup(name=NAME,
           'epubaker.xl'
       ],
       install_requires=requirements,
+      python_requires='>=3.4',
       classifiers=CLASSIFIERS)
@@ -1,3 +1,6 @@
+import io
+import shutil
+import tempfile
 import uuid
 import zipfile
 from xml.etree import ElementTree as Et
@@ -18,9 +21,11 @@ XHTML_TEMPLATE = """
 
 cur_path = os.path.dirname(__file__)
 
-BUILT_BOOK_DIR = '_test_built_book'
-if not os.path.exists(BUILT_BOOK_DIR):
-    os.makedirs(BUILT_BOOK_DIR)
+BUILT_BOOK_DIR = tempfile.mkdtemp(prefix='epubaker_test_')
+
+
+def teardown_module():
+    shutil.rmtree(BUILT_BOOK_DIR, ignore_errors=True)
 
 
 def make_epub(epub, section):
@@ -117,3 +122,565 @@ def test_epub2():
     book.write(book_path)
 
     check_xml(book_path)
+
+
+class _UnseekableSink(object):
+    def __init__(self):
+        self.data = b''
+
+    def write(self, data):
+        self.data += bytes(data)
+
+
+def check_zip(binary):
+    z = zipfile.ZipFile(io.BytesIO(binary), 'r')
+    assert z.testzip() is None
+    assert z.namelist()[0] == 'mimetype'
+    assert binary[30:38] == b'mimetype'
+    assert binary[38:58] == b'application/epub+zip'
+    return z
+
+
+def test_write_to():
+    from epubaker import Epub3
+
+    book = make_epub(Epub3, Section)
+    book.files['cover.png'] = File(open(os.path.join(cur_path, 'cover', 'cover.png'), 'rb').read())
+
+    sink = _UnseekableSink()
+    book.write_to(sink)
+
+    z = check_zip(sink.data)
+    assert z.read('EPUB/cover.png') == book.files['cover.png'].binary
+
+
+def test_iter_bytes():
+    from epubaker import Epub2
+
+    book = make_epub(Epub2, Section)
+    book.files['cover.png'] = File(open(os.path.join(cur_path, 'cover', 'cover.png'), 'rb').read())
+
+    chunks = list(book.iter_bytes(chunk_size=1024))
+
+    assert all(len(chunk) == 1024 for chunk in chunks[:-1])
+    assert 0 < len(chunks[-1]) <= 1024
+
+    z = check_zip(b''.join(chunks))
+    assert z.read('EPUB/cover.png') == book.files['cover.png'].binary
+
+
+def test_lazy_files():
+    import mmap
+    from epubaker import Epub3
+
+    cover_path = os.path.join(cur_path, 'cover', 'cover.png')
+    cover_binary = open(cover_path, 'rb').read()
+
+    book = make_epub(Epub3, Section)
+
+    book.files['path.png'] = File.from_path(cover_path)
+
+    with open(cover_path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    book.files['mmap.png'] = File.from_mmap(mm)
+
+    book.files['callable.png'] = File.from_callable(lambda: open(cover_path, 'rb'))
+
+    page = XHTML_TEMPLATE.format(title='Lazy', content='<script>var a = 1;</script>').encode()
+    book.files['lazy.xhtml'] = File.from_callable(lambda: io.BytesIO(page), mime='application/xhtml+xml')
+    book.spine.append(Joint('lazy.xhtml'))
+
+    for path in ('path.png', 'mmap.png', 'callable.png'):
+        assert book.files[path].binary == cover_binary
+
+    assert book.files['path.png'].size == book.files['mmap.png'].size == len(cover_binary)
+    assert book.files['callable.png'].size is None
+
+    cover_page = book.addons_make_image_page('mmap.png')
+    assert b'width="' in cover_page.binary
+
+    z = check_zip(b''.join(book.iter_bytes()))
+    for path in ('path.png', 'mmap.png', 'callable.png'):
+        assert z.read('EPUB/' + path) == cover_binary
+
+    assert 'properties="scripted"' in z.read('EPUB/package.opf').decode()
+    mm.close()
+
+
+def test_parallel_write():
+    from epubaker import Epub3
+
+    cover_path = os.path.join(cur_path, 'cover', 'cover.png')
+
+    book = make_epub(Epub3, Section)
+    book.files['cover.png'] = File.from_path(cover_path)
+    book.files['big.txt'] = File(os.urandom(300 * 1024) + b'epubaker ' * 100000, mime='text/plain')
+    book.files['empty.txt'] = File(b'', mime='text/plain')
+
+    for executor in ('thread', 'process'):
+        z = check_zip(b''.join(book.iter_bytes(workers=3, executor=executor)))
+
+        for path in ('cover.png', 'big.txt', 'empty.txt'):
+            assert z.read('EPUB/' + path) == book.files[path].binary
+
+
+def test_compression_policy():
+    from epubaker import Epub3
+    from epubaker.compression import CompressionPolicy
+
+    book = make_epub(Epub3, Section)
+    book.files['cover.png'] = File.from_path(os.path.join(cur_path, 'cover', 'cover.png'))
+    book.files['noise.bin'] = File(os.urandom(64 * 1024), mime='application/octet-stream')
+    book.files['keep.svg'] = File(b'<svg/>', compress_type=zipfile.ZIP_STORED)
+
+    z = check_zip(b''.join(book.iter_bytes()))
+    assert z.getinfo('EPUB/cover.png').compress_type == zipfile.ZIP_STORED
+    assert z.getinfo('EPUB/keep.svg').compress_type == zipfile.ZIP_STORED
+    assert z.getinfo('EPUB/noise.bin').compress_type == zipfile.ZIP_DEFLATED
+    assert z.getinfo('EPUB/pi_c1.xhtml').compress_type == zipfile.ZIP_DEFLATED
+
+    z = check_zip(b''.join(book.iter_bytes(policy=CompressionPolicy(sample_size=16 * 1024))))
+    assert z.getinfo('EPUB/noise.bin').compress_type == zipfile.ZIP_STORED
+    assert z.getinfo('EPUB/pi_c1.xhtml').compress_type == zipfile.ZIP_DEFLATED
+    assert z.read('EPUB/noise.bin') == book.files['noise.bin'].binary
+
+
+def test_entry_cache():
+    from epubaker import Epub3
+    from epubaker.cache import EntryCache
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        book = make_epub(Epub3, Section)
+        book.files['style.css'] = File(b'p { margin: 0; }\n' * 1000)
+
+        cache = EntryCache(cache_dir)
+        first = check_zip(b''.join(book.iter_bytes(cache=cache)))
+
+        key = EntryCache.key(book.files['style.css'], -1)
+        crc, file_size, f = cache.get(key)
+        f.close()
+        assert (crc, file_size) == (first.getinfo('EPUB/style.css').CRC, len(book.files['style.css'].binary))
+
+        for workers in (None, 2):
+            z = check_zip(b''.join(book.iter_bytes(cache=cache, workers=workers)))
+            assert z.read('EPUB/style.css') == book.files['style.css'].binary
+            assert z.getinfo('EPUB/style.css').compress_size == first.getinfo('EPUB/style.css').compress_size
+
+        # the oldest is removed first, entries written in the same moment are in any order
+        os.utime(cache._path(key), (0, 0))
+
+        small_cache = EntryCache(cache_dir, max_size=1024)
+        small_cache.evict()
+        assert small_cache.get(key) is None
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_write_with_base():
+    from epubaker import Epub3
+
+    book = make_epub(Epub3, Section)
+    book.files['cover.png'] = File.from_path(os.path.join(cur_path, 'cover', 'cover.png'))
+    book.files['style.css'] = File(b'p { margin: 0; }\n' * 1000)
+
+    book_path = os.path.join(BUILT_BOOK_DIR, 'base.epub')
+    # no earlier build yet
+    book.write(book_path, base=book_path)
+    first = zipfile.ZipFile(book_path).getinfo('EPUB/style.css')
+
+    book.files['pi_c1.xhtml'] = File(XHTML_TEMPLATE.format(title='Chapter 1', content='fixed typo').encode(),
+                                     mime='application/xhtml+xml')
+
+    for workers in (None, 2):
+        book.write(book_path, base=book_path, workers=workers)
+
+        z = check_zip(open(book_path, 'rb').read())
+        assert b'fixed typo' in z.read('EPUB/pi_c1.xhtml')
+        assert z.read('EPUB/cover.png') == book.files['cover.png'].binary
+        assert z.read('EPUB/style.css') == book.files['style.css'].binary
+        assert z.getinfo('EPUB/style.css').compress_size == first.compress_size
+
+
+def test_failed_write():
+    from epubaker import Epub3
+    from epubaker.archive import ZipWriter
+
+    book = make_epub(Epub3, Section)
+    book_path = os.path.join(BUILT_BOOK_DIR, 'failed.epub')
+    book.write(book_path)
+    data = open(book_path, 'rb').read()
+
+    def broken():
+        raise IOError('gone')
+
+    # base is the file written, it is kept until the new one is done
+    book.files['broken.css'] = File.from_callable(broken)
+    try:
+        book.write(book_path, base=book_path)
+    except IOError:
+        pass
+    else:
+        raise AssertionError('write should fail')
+
+    assert open(book_path, 'rb').read() == data
+    assert [name for name in os.listdir(BUILT_BOOK_DIR) if name.endswith('.tmp')] == []
+
+    # other files are written in place
+    del book.files['broken.css']
+    if hasattr(os, 'symlink'):
+        link_path = os.path.join(BUILT_BOOK_DIR, 'link.epub')
+        os.symlink(book_path, link_path)
+        book.write(link_path)
+        assert os.path.islink(link_path)
+        check_zip(open(book_path, 'rb').read())
+        os.remove(link_path)
+
+    os.remove(book_path)
+
+    # an entry failed is left out, the zip can still be written on
+    sink = io.BytesIO()
+    zip_writer = ZipWriter(sink)
+    try:
+        with zip_writer.open('a.txt') as f:
+            f.write(b'a')
+            raise IOError('gone')
+    except IOError:
+        pass
+
+    try:
+        f.write(b'a')
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('failed entry written')
+
+    with zip_writer.open('b.txt') as f:
+        f.write(b'b')
+    zip_writer.close()
+
+    z = zipfile.ZipFile(sink, 'r')
+    assert z.testzip() is None
+    assert z.namelist() == ['b.txt']
+    assert z.read('b.txt') == b'b'
+
+def test_manifest():
+    from epubaker import Epub3
+
+    book = make_epub(Epub3, Section)
+    book.files['a.svg'] = File(b'<svg/>', fallback='b.png')
+    book.files['b.png'] = File(b'', fallback='c.jpg')
+    book.files['c.jpg'] = File(b'')
+    book.files['a/svg'] = File(b'', mime='image/svg+xml')
+    book.files['a__svg'] = File(b'', mime='image/svg+xml')
+
+    manifest = book._make_manifest()
+    paths = [item.attributes[(None, 'href')] for item in manifest.element.children]
+    assert paths.index('c.jpg') < paths.index('b.png') < paths.index('a.svg')
+
+    assert len(set(manifest.ids.values())) == len(paths)
+    assert manifest.items[manifest.ids['a.svg']].attributes[(None, 'fallback')] == manifest.ids['b.png']
+
+    book.files['c.jpg'].fallback = 'a.svg'
+    try:
+        book._make_manifest()
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('fallback loop not found')
+
+
+def test_unused_filename():
+    from epubaker import Epub3
+
+    book = make_epub(Epub3, Section)
+    book.files['nav.xhtml'] = File(b'')
+    book.files['Nav_1.xhtml'] = File(b'')
+
+    assert book._get_unused_filename(None, 'nav.xhtml') == 'nav_2.xhtml'
+    assert book._get_unused_filename(None, 'toc.ncx') == 'toc.ncx'
+
+    try:
+        book.files['NAV.xhtml'] = File(b'')
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('case-insensitive collision not found')
+
+    book.files['nav.xhtml'] = File(b'replaced')
+    del book.files['nav.xhtml']
+    book.files['NAV.xhtml'] = File(b'')
+
+    z = check_zip(b''.join(book.iter_bytes()))
+    assert 'EPUB/nav_2.xhtml' in z.namelist()
+
+    # a freed name is handed out again
+    book.files['nav_2.xhtml'] = File(b'')
+    assert book._get_unused_filename(None, 'nav.xhtml') == 'nav_3.xhtml'
+    del book.files['Nav_1.xhtml']
+    assert book._get_unused_filename(None, 'nav.xhtml') == 'nav_1.xhtml'
+
+
+def test_generated_documents_cache():
+    from epubaker import Epub3
+    from epubaker.metas import Creator
+
+    book = make_epub(Epub3, Section)
+
+    made = []
+    make_nav_element = book._make_nav_element
+
+    def counting_make_nav_element():
+        made.append('nav')
+        return make_nav_element()
+
+    book._make_nav_element = counting_make_nav_element
+
+    def read(name):
+        return check_zip(b''.join(book.iter_bytes())).read(name)
+
+    ncx = read('EPUB/toc.ncx')
+    opf = read('EPUB/package.opf')
+    assert read('EPUB/toc.ncx') == ncx
+    assert read('EPUB/package.opf') == opf
+    assert made == ['nav']
+
+    book.metadata.append(Creator('somebody'))
+    assert read('EPUB/package.opf') != opf
+    assert read('EPUB/toc.ncx') == ncx
+    assert made == ['nav']
+
+    book.toc[0].subs[0].title = 'Chapter One'
+    assert b'Chapter One' in read('EPUB/nav.xhtml')
+    assert b'Chapter One' in read('EPUB/toc.ncx')
+    assert made == ['nav', 'nav']
+
+    book.files['pi_c1.xhtml'].mime = 'text/html'
+    assert b'media-type="text/html"' in read('EPUB/package.opf')
+
+    # reordered in place
+    book.spine.reverse()
+    opf = read('EPUB/package.opf')
+    assert opf.index(b'idref="piii_c2.xhtml"') < opf.index(b'idref="Part_I.xhtml"')
+
+    book.toc.reverse()
+    book.toc[1].subs.sort(key=lambda section: section.href, reverse=True)
+    for name in ('EPUB/nav.xhtml', 'EPUB/toc.ncx'):
+        document = read(name)
+        assert document.index(b'Part_III.xhtml"') < document.index(b'Part_I.xhtml"')
+        assert document.index(b'pii_c2.xhtml"') < document.index(b'pii_c1.xhtml"')
+    assert made == ['nav', 'nav', 'nav']
+
+    # changes to another book leave the caches of this one
+    other = make_epub(Epub3, Section)
+    other.files['pi_c1.xhtml'].mime = 'text/html'
+    other.toc[0].subs[0].title = 'Other'
+    assert read('EPUB/toc.ncx') == read('EPUB/toc.ncx')
+    assert made == ['nav', 'nav', 'nav']
+
+    # a file changed on disk is scanned again
+    dire = tempfile.mkdtemp()
+    try:
+        path = os.path.join(dire, 'page.xhtml')
+        with open(path, 'wb') as f:
+            f.write(XHTML_TEMPLATE.format(title='Disk', content='plain').encode())
+        book.files['disk.xhtml'] = File.from_path(path)
+        assert b'properties="scripted"' not in read('EPUB/package.opf')
+
+        with open(path, 'wb') as f:
+            f.write(XHTML_TEMPLATE.format(title='Disk', content='<script/>').encode())
+        os.utime(path, (0, 0))
+        assert b'properties="scripted"' in read('EPUB/package.opf')
+    finally:
+        shutil.rmtree(dire)
+
+
+def test_scan_properties():
+    from epubaker.scanner import scan_properties
+
+    page = XHTML_TEMPLATE.format(title='Scan', content="""
+    <a href="http://example.com/">link only</a>
+    <math xmlns="http://www.w3.org/1998/Math/MathML"><mi>x</mi></math>
+    <svg xmlns="http://www.w3.org/2000/svg"><rect/></svg>
+    <epub:switch xmlns:epub="http://www.idpf.org/2007/ops"><epub:default/></epub:switch>
+    <img src="https://example.com/a.png"/>
+    <script type="text/javascript">if (1 &lt; 2) {}</script>""").encode()
+
+    chunks = [page[i:i + 7] for i in range(0, len(page), 7)]
+    assert scan_properties(chunks) == ['scripted', 'mathml', 'svg', 'remote-resources', 'switch']
+
+    page = XHTML_TEMPLATE.format(title='Scan', content='<a href="http://example.com/">link only</a>').encode()
+    assert scan_properties([page]) == []
+
+
+def test_properties_store():
+    from epubaker.scanner import scan_file_properties, properties_key
+    from epubaker.stores import MemoryStore, SQLiteStore, DirectoryStore
+    from epubaker import Epub3
+
+    page = File(XHTML_TEMPLATE.format(title='Store', content='<svg xmlns="http://www.w3.org/2000/svg"/>').encode())
+    key = properties_key(page)
+
+    dire = tempfile.mkdtemp()
+    try:
+        stores = [MemoryStore(max_entries=1),
+                  SQLiteStore(os.path.join(dire, 'properties.db')),
+                  DirectoryStore(os.path.join(dire, 'properties'))]
+
+        for store in stores:
+            assert store.get(key) is None
+            assert scan_file_properties(page, store) == ['svg']
+            assert store.get(key) == 'svg'
+
+            # taken from the store, not scanned again
+            store.set(key, 'mathml')
+            assert scan_file_properties(page, store) == ['mathml']
+
+        stores[0].set('other', '')
+        assert stores[0].get(key) is None
+
+        book = Epub3()
+        book.properties_store = stores[1]
+        book.files['a.xhtml'] = page
+        assert b'properties="mathml"' in book._get_opf_data('nav.xhtml')
+        stores[1].close()
+    finally:
+        shutil.rmtree(dire)
+
+
+def test_scan_files_properties():
+    from epubaker.scanner import scan_files_properties
+    from epubaker.stores import MemoryStore
+
+    contents = ['<svg xmlns="http://www.w3.org/2000/svg"/>', '<script/>', '<p>plain</p>']
+    pages = [XHTML_TEMPLATE.format(title=str(i), content=content).encode() for i, content in enumerate(contents)]
+    files = [File(pages[0]), File.from_callable(lambda: io.BytesIO(pages[1])), File(pages[2])]
+    expected = [['svg'], ['scripted'], []]
+
+    assert scan_files_properties(files) == expected
+    assert scan_files_properties(files, workers=2, batch_size=1, min_parallel_size=0) == expected
+
+    store = MemoryStore()
+    assert scan_files_properties(files[:1], store=store) == expected[:1]
+    assert scan_files_properties(files, workers=2, store=store, batch_size=1, min_parallel_size=0) == expected
+
+    # files on disk are read by the workers, the callable of unknown size counts as big enough for them
+    dire = tempfile.mkdtemp()
+    try:
+        path = os.path.join(dire, 'page.xhtml')
+        with open(path, 'wb') as f:
+            f.write(pages[0])
+
+        files[0] = File.from_path(path)
+        assert scan_files_properties(files, workers=2, batch_size=1) == expected
+    finally:
+        shutil.rmtree(dire)
+
+
+def test_compact_documents():
+    from epubaker import Epub3
+
+    book = make_epub(Epub3, Section)
+    pretty_opf = book._make_opf_data()
+
+    book.xml_indent = None
+    compact_opf = book._make_opf_data()
+
+    assert b'\n' not in compact_opf and b'\n' not in book._get_nav_data()
+    assert len(compact_opf) < len(pretty_opf)
+    Et.fromstring(compact_opf)
+
+
+def test_escaped_hrefs():
+    from epubaker import Epub3
+
+    book = make_epub(Epub3, Section)
+    book.files['Q&A "1".xhtml'] = File(XHTML_TEMPLATE.format(title='Q', content='A').encode())
+    hrefs = [e.attrib['href'] for e in Et.fromstring(book._make_opf_data()).iter('{http://www.idpf.org/2007/opf}item')]
+    assert 'Q&A "1".xhtml' in hrefs
+
+
+def test_generated_documents_parse_back():
+    from epubaker import Epub3
+    from epubaker.xl import parse
+    from test.test_xl import _available_backends
+
+    book = make_epub(Epub3, Section)
+    book.files['toc.xhtml'] = book.addons_make_toc_page()
+
+    f = io.BytesIO()
+    book.write_to(f)
+    z = zipfile.ZipFile(f)
+
+    for name in z.namelist():
+        if name.endswith(('.opf', '.ncx', 'nav.xhtml', 'toc.xhtml', 'container.xml')):
+            data = z.read(name)
+            for backend in _available_backends():
+                assert parse(data, backend=backend).to_bytes() == data
+
+
+def test_direct_opf():
+    from epubaker import Epub2, Epub3
+
+    def opf_of(book):
+        opfs = []
+        for opf_tree in (True, False):
+            book.opf_tree = opf_tree
+            opfs.append(book._make_opf_data())
+            book._temp_files.clear()
+
+        assert opfs[0] == opfs[1]
+        return opfs[0]
+
+    for epub in (Epub2, Epub3):
+        book = make_epub(epub, Section)
+        book.files['a.svg'] = File(b'<svg/>', fallback='b&"é".png')
+        book.files['b&"é".png'] = File(b'')
+
+        for indent in (4, None):
+            book.xml_indent = indent
+
+            book.spine[0].linear = False
+            book.spine.append(Joint('a.svg', linear=True))
+            assert b'linear="no"' in opf_of(book)
+
+            del book.spine[1:]
+            assert b'<spine toc="toc.ncx"><itemref' in opf_of(book)
+
+            joint = book.spine.pop()
+            assert b'<spine toc="toc.ncx" />' in opf_of(book)
+
+            book.spine.append(joint)
+
+
+def test_toc_depth_and_play_order():
+    import sys
+    from epubaker import Epub3
+
+    book = make_epub(Epub3, Section)
+    ncx = Et.fromstring(book._get_ncx_data())
+
+    ns = {'ncx': 'http://www.daisy.org/z3986/2005/ncx/'}
+    assert ncx.find("ncx:head/ncx:meta[@name='dtb:depth']", ns).attrib['content'] == '2'
+
+    points = ncx.findall('.//ncx:navPoint', ns)
+    play_orders = [int(point.attrib['playOrder']) for point in points]
+    # Part II has no href, it goes to its first chapter
+    assert play_orders == [1, 2, 3, 4, 4, 5, 6, 7, 8]
+
+    book.toc.ncx_depth = 5
+    assert b'<meta name="dtb:depth" content="5" />' in book._get_ncx_data()
+
+    # deeper than recursion can go
+    book.xml_indent = None
+    section = book.toc[0]
+    for i in range(sys.getrecursionlimit() + 100):
+        sub = Section('Section {}'.format(i), 'Part_I.xhtml#s{}'.format(i))
+        section.subs.append(sub)
+        section = sub
+
+    book.toc.ncx_depth = None
+    ncx = Et.fromstring(book._get_ncx_data())
+    depth = sys.getrecursionlimit() + 101
+    assert ncx.find("ncx:head/ncx:meta[@name='dtb:depth']", ns).attrib['content'] == str(depth)
+    assert book._get_nav_data().count(b'<li>') == len(ncx.findall('.//ncx:navPoint', ns))
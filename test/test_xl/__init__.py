@@ -36,3 +36,253 @@ def test_parse():
 
     xl.root = pretty_e
     Et.fromstring(xl.string())
+
+
+def test_write():
+    import io
+    from epubaker.xl import Xl, Element
+
+    xl = parse(open(TEST_XML_PATH).read())
+
+    stream = io.StringIO()
+    xl.write(stream)
+    assert stream.getvalue() == xl.string()
+    assert ''.join(xl.root.iter_chunks(chunk_size=16)) == xl.root.string()
+
+    # deeper than the recursion limit
+    root = e = Element('a')
+    for _ in range(5000):
+        sub = Element('a')
+        e.children.append(sub)
+        e = sub
+    e.children.append('text')
+
+    assert Xl(root=root).string() == '<a>' * 5001 + 'text' + '</a>' * 5001
+
+
+def test_to_bytes():
+    import io
+    from epubaker.xl import Xl, Header, Element
+
+    e = Element('p')
+    e.children.append('café €')
+
+    assert Xl(root=e).to_bytes() == '<p>café €</p>'.encode('utf-8')
+
+    xl = Xl(header=Header(encoding='iso-8859-1'), root=e)
+    assert xl.to_bytes() == '<?xml version="1.0" encoding="iso-8859-1" ?>\n<p>café &#8364;</p>'.encode('latin-1')
+    assert xl.to_bytes('ascii') == b'<?xml version="1.0" encoding="ascii" ?>\n<p>caf&#233; &#8364;</p>'
+
+    stream = io.BytesIO()
+    xl.write_bytes(stream, chunk_size=4, encoding='utf-16')
+    assert stream.getvalue().decode('utf-16') == xl.string().replace('iso-8859-1', 'utf-16')
+
+
+def test_indent():
+    from epubaker.xl import Element
+
+    e = parse(open(TEST_XML_PATH).read()).root
+
+    assert e.string(indent=4) == pretty_insert(e).string()
+    assert e.string(indent=2, compact_single_child=False) == \
+        pretty_insert(e, step=2, dont_do_when_one_child=False).string()
+    assert e.string(strip_whitespaces=True) == clean_whitespaces(e).string()
+    assert e.string(indent=4, strip_whitespaces=True) == pretty_insert(clean_whitespaces(e)).string()
+
+    a = Element('a')
+    b = Element('b')
+    a.children.extend(['  ', b])
+    b.children.extend([Element('c'), 'text'])
+    assert a.string(indent=2) == '<a>\n    \n  <b>\n    <c />\n    text\n  </b>\n</a>'
+    assert a.string(indent=2, strip_whitespaces=True) == '<a>\n  <b>\n    <c />\n    text\n  </b>\n</a>'
+
+
+def test_escape():
+    from epubaker.xl import Element
+
+    value = 'AT&T "quoted" <tag>'
+    e = Element('a', attributes={'title': value})
+    e.children.append(value)
+
+    assert e.string() == '<a title="AT&amp;T &quot;quoted&quot; &lt;tag&gt;">AT&amp;T "quoted" &lt;tag&gt;</a>'
+
+    et_e = Et.fromstring(e.string())
+    assert et_e.attrib['title'] == value and et_e.text == value
+
+
+def test_prefixes():
+    from epubaker.xl import Element
+
+    root = Element(('urn:a', 'root'), prefixes={'urn:a': 'a'})
+    child = Element(('urn:b', 'child'), attributes={('urn:a', 'x'): '1'})
+    sub = Element(('urn:b', 'sub'), prefixes={'urn:b': 'b'})
+    root.children.append(child)
+    child.children.extend([sub, Element(('urn:b', 'sub'))])
+
+    assert root.string() == ('<a:root xmlns:a="urn:a"><prefix0:child a:x="1" xmlns:prefix0="urn:b">'
+                             '<b:sub xmlns:b="urn:b" /><prefix0:sub /></prefix0:child></a:root>')
+
+    et_root = Et.fromstring(root.string())
+    assert [e.tag for e in et_root.iter()] == ['{urn:a}root', '{urn:b}child', '{urn:b}sub', '{urn:b}sub']
+    assert et_root[0].attrib == {'{urn:a}x': '1'}
+
+
+def test_element():
+    import copy
+    from epubaker.xl import Element, URI_XML
+
+    e = Element('p', attributes={'class': 'c'})
+    assert e.tag is Element('p').tag
+    assert list(e.attributes.keys()) == [(None, 'class')]
+    assert e.prefixes == {URI_XML: 'xml'}
+
+    for bad in (lambda: e.children.append(1), lambda: e.children.extend(['a', 1]), lambda: e.children.insert(0, None)):
+        try:
+            bad()
+        except TypeError:
+            pass
+        else:
+            assert False
+
+    assert e.children == []
+
+    e.children += ['text', Element('br')]
+    e.prefixes['urn:a'] = 'a'
+    try:
+        e.prefixes['urn:b'] = 'a'
+    except ValueError:
+        pass
+    else:
+        assert False
+
+    assert copy.deepcopy(e).string() == e.string() == '<p class="c" xmlns:a="urn:a">text<br /></p>'
+
+    # names are shared, but not kept forever
+    from epubaker.xl import xl
+    for i in range(xl._MAX_NAMES * 2):
+        Element('tag{}'.format(i))
+    assert len(xl._names) <= xl._MAX_NAMES
+    assert Element('p').string() == '<p />'
+
+
+def test_iterparse():
+    import io
+    from epubaker.xl import iterparse, Parser
+
+    data = '<?xml version="1.0" encoding="utf-8"?>\n<ol><li id="1">é<b>1</b></li><li id="2">two</li></ol>'.encode()
+
+    parser = Parser()
+    for i in range(len(data)):
+        parser.feed(data[i:i + 1])
+    xl = parser.close()
+    assert xl.header.encoding == 'utf-8'
+    assert xl.root.string() == '<ol><li id="1">é<b>1</b></li><li id="2">two</li></ol>'
+
+    events = [(event, value if event == 'text' else value.tag[1])
+              for event, value in iterparse(io.BytesIO(data), events=('start', 'end', 'text'), chunk_size=3)]
+    assert events == [('start', 'ol'), ('start', 'li'), ('text', 'é'), ('start', 'b'), ('text', '1'), ('end', 'b'),
+                      ('end', 'li'), ('start', 'li'), ('text', 'two'), ('end', 'li'), ('end', 'ol')]
+
+    # only subtrees asked for are built
+    ends = [e for _, e in iterparse([data], build=lambda e: e.attributes.get((None, 'id')) == '1')]
+    assert [e.string() for e in ends] == ['<b>1</b>', '<li id="1">é<b>1</b></li>', '<li id="2" />', '<ol />']
+
+
+def test_parse_prefixes():
+    xl = parse('<a xmlns="urn:a" xmlns:x="urn:x"><b x:y="1"/><c xmlns="urn:c"><d/></c></a>')
+    a = xl.root
+    b, c = a.children
+    d = c.children[0]
+
+    # shared until an element declares others
+    assert a._prefixes is b._prefixes and c._prefixes is d._prefixes and a._prefixes is not c._prefixes
+    assert d.tag == ('urn:c', 'd') and b.attributes == {('urn:x', 'y'): '1'}
+
+    # changed on a copy of its own
+    b.prefixes['urn:z'] = 'z'
+    assert 'urn:z' not in a.prefixes
+
+    assert xl.string() == ('<a xmlns="urn:a" xmlns:x="urn:x"><b x:y="1" xmlns:z="urn:z" />'
+                           '<c xmlns="urn:c"><d /></c></a>')
+    assert c.string() == '<c xmlns:x="urn:x" xmlns="urn:c"><d /></c>'
+
+    text = 'a &amp; b ' * 10000
+    assert parse('<p>' + text + '</p>').root.children == [text.replace('&amp;', '&')]
+
+
+def _available_backends():
+    from epubaker.xl import BACKENDS
+
+    backends = []
+    for backend in BACKENDS:
+        try:
+            parse('<a/>', backend=backend)
+        except ImportError:
+            continue
+        backends.append(backend)
+
+    return backends
+
+
+def test_backends():
+    import io
+    from epubaker.xl import iterparse
+
+    docs = [open(TEST_XML_PATH, 'rb').read(),
+            b'<?xml version="1.0" encoding="iso-8859-1" standalone="yes"?>\n'
+            b'<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">\n'
+            b'<html xmlns="http://www.w3.org/1999/xhtml" xmlns:e="urn:e"><body e:x="1">a<!-- c -->b<p>\xe9</p>'
+            b'tail<![CDATA[<cd>]]><q xmlns="urn:q"/></body></html>',
+            '<a xmlns:p="urn:1"><p:b p:c="2">x &amp; y</p:b><c xmlns:p="urn:2"><p:d/></c></a>'.encode('utf-16'),
+            b'<r>a<!-- c -->b<?pi x?>c<p/>d</r>']
+
+    for data in docs:
+        results = set()
+        for backend in _available_backends():
+            xl = parse(data, backend=backend)
+            events = [(event, value if event == 'text' else value.tag)
+                      for event, value in iterparse(io.BytesIO(data), ('start', 'end', 'text'), chunk_size=3,
+                                                    backend=backend)]
+            results.add((xl.to_bytes(), xl.header and xl.header.string(), xl.doc_type and xl.doc_type.string(),
+                         tuple(events)))
+
+        assert len(results) == 1
+
+
+def test_find():
+    import copy
+    from epubaker.xl import Element, URI_XML
+
+    html = parse('<html xmlns="urn:h"><body><p id="a" class="x">1</p><div><p class="x" xml:id="b">2</p>'
+                 '<p class="y">3</p></div></body></html>').root
+
+    assert [e.children[0] for e in html.find_all(('urn:h', 'p'))] == ['1', '2', '3']
+    assert [e.children[0] for e in html.find_all(attributes={'class': 'x'})] == ['1', '2']
+    assert html.find(('urn:h', 'p'), predicate=lambda e: e.children == ['3']).attributes[(None, 'class')] == 'y'
+    assert html.find_by_id('a').children == ['1'] and html.find_by_id('b').children == ['2']
+    assert html.find('p') is None and html.find_by_id('c') is None
+
+    index = html._index
+    html.find_all(attributes={'class': 'y'})
+    assert html._index is index
+
+    # changes make the index out of date
+    html.find_by_id('b').attributes[(URI_XML, 'id')] = 'c'
+    assert html.find_by_id('b') is None and html.find_by_id('c').children == ['2']
+    assert html._index is not index
+
+    html.find(('urn:h', 'div')).children.pop()
+    assert len(html.find_all(('urn:h', 'p'))) == 2
+
+    # changes to other trees, and elements made, leave the index as it is
+    index = html._index
+    other = parse('<html><p id="a">1</p></html>').root
+    other.find_by_id('a').attributes['id'] = 'b'
+    other.children.append(Element('p'))
+    assert html.find_by_id('c') is not None and html._index is index
+
+    # copies are not in the index
+    copied = copy.deepcopy(html)
+    copied.find_by_id('c').attributes['class'] = 'z'
+    assert html.find_by_id('c').attributes[(None, 'class')] == 'x' and html._index is index
+    assert [e.attributes[(None, 'class')] for e in copied.find_all(('urn:h', 'p'))] == ['x', 'z']